@@ -11,8 +11,8 @@ IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 or implied.
 """
 
-import os, json, requests, urllib3, openpyxl, time
-import pandas as pd
+import os, re, csv, json, math, random, hashlib, requests, urllib3, time, sqlite3, threading, argparse
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # suppress unverified HTTPS request warnings
@@ -20,10 +20,67 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # environment variables
 load_dotenv()
+vmanage_scheme = os.getenv("VMANAGE_SCHEME", "https")
 vmanage_host = os.getenv("VMANAGE_HOST")
 vmanage_port = os.getenv("VMANAGE_PORT")
 vmanage_username = os.getenv("VMANAGE_USERNAME")
 vmanage_password = os.getenv("VMANAGE_PASSWORD")
+vmanage_cache_file = os.getenv("VMANAGE_CACHE_FILE", ".vmanage_cache.sqlite")
+vmanage_cache_max_entries = int(os.getenv("VMANAGE_CACHE_MAX_ENTRIES", "2000"))
+vmanage_concurrency = int(os.getenv("VMANAGE_CONCURRENCY", "8"))
+vmanage_attach_chunk_devices = int(os.getenv("VMANAGE_ATTACH_CHUNK_DEVICES", "200"))
+vmanage_attach_chunk_bytes = int(os.getenv("VMANAGE_ATTACH_CHUNK_BYTES", "2000000"))
+vmanage_action_timeout = int(os.getenv("VMANAGE_ACTION_TIMEOUT", "1800"))
+vmanage_action_poll_interval = float(os.getenv("VMANAGE_ACTION_POLL_INTERVAL", "2"))
+vmanage_pool_size = int(os.getenv("VMANAGE_POOL_SIZE", "0")) or max(vmanage_concurrency, 10)
+vmanage_keep_alive = os.getenv("VMANAGE_KEEP_ALIVE", "true").lower() == "true"
+vmanage_max_retries = int(os.getenv("VMANAGE_MAX_RETRIES", "4"))
+vmanage_retry_backoff = float(os.getenv("VMANAGE_RETRY_BACKOFF", "1"))
+vmanage_retry_backoff_max = float(os.getenv("VMANAGE_RETRY_BACKOFF_MAX", "30"))
+vmanage_rate_read = float(os.getenv("VMANAGE_RATE_READ", "50"))
+vmanage_rate_write = float(os.getenv("VMANAGE_RATE_WRITE", "20"))
+vmanage_rate_push = float(os.getenv("VMANAGE_RATE_PUSH", "5"))
+vmanage_latency_target = float(os.getenv("VMANAGE_LATENCY_TARGET", "5"))
+vmanage_max_push_jobs = int(os.getenv("VMANAGE_MAX_PUSH_JOBS", "10"))
+metrics_export = os.getenv("METRICS_EXPORT", "")
+input_snapshot_file = os.getenv("INPUT_SNAPSHOT", "")
+template_changes_file = os.getenv("TEMPLATE_CHANGES_FILE", "")
+vmanage_journal_file = os.getenv("VMANAGE_JOURNAL_FILE", ".vmanage_journal.jsonl")
+batch_max_parallel_jobs = int(os.getenv("BATCH_MAX_PARALLEL_JOBS", "4"))
+json_codec_name = os.getenv("JSON_CODEC", "auto")
+rollout_canary_size = int(os.getenv("ROLLOUT_CANARY_SIZE", "1"))
+rollout_growth_factor = float(os.getenv("ROLLOUT_GROWTH_FACTOR", "2"))
+rollout_max_in_flight = int(os.getenv("ROLLOUT_MAX_IN_FLIGHT", "50"))
+rollout_max_failure_rate = float(os.getenv("ROLLOUT_MAX_FAILURE_RATE", "0.1"))
+
+# time-to-live in seconds of cached vManage reads, matched by longest endpoint prefix
+cache_ttls = {
+    "system/device": 300,
+    "template/device": 900,
+    "template/feature": 900,
+    "template/feature/object": 900,
+    "template/device/object": 900,
+    "template/device/config/input": 300,
+    "template/device/config/attached": 120
+}
+
+# shared on-disk cache of vManage reads, created on first use
+response_cache = None
+cache_refresh = False
+
+# only reattach routers whose template or template input values change, and only show the changes on a dry run
+diff_mode = False
+dry_run = False
+
+# skip the steps an interrupted run recorded as finished in the run journal
+resume_run = False
+
+# endpoints that start a job pushing configuration to devices or controllers
+push_endpoints = (
+    "template/device/config/attachfeature",
+    "template/config/device/mode/cli",
+    "certificate/vedge/list"
+)
 
 # define available workflows
 workflows = [
@@ -34,6 +91,15 @@ workflows = [
     "Configure changes to existing store/branch edge routers"
 ]
 
+# workflow names used in batch job files
+workflow_ids = {
+    "commission": 1,
+    "decommission": 2,
+    "rma": 3,
+    "reclassification": 4,
+    "configure_changes": 5
+}
+
 # define available sub-workflows for commission_router
 commission_router_subworkflows = [
     "Link templates and get template input variables",
@@ -46,198 +112,301 @@ reclassification_subworkflows = [
     "Upload data and reattach routers"
 ]
 
+# template changes applied by configure_changes unless a TEMPLATE_CHANGES_FILE is given:
+# copy the template with a name suffix, add an SVI Vlan100 feature template under the VPN template,
+# and set these input values per router, where {index} counts the routers from 1
+default_template_changes = {
+    "nameSuffix": "-Changed",
+    "featureTemplates": [{
+        "parentTemplateType": "cisco_vpn",
+        "template": {
+            "templateName": "C8000v-Alvin-Test-SVI-100",
+            "templateDescription": "C8000v-Alvin-Test-SVI-100",
+            "templateType": "vpn-interface-svi",
+            "deviceType": [ "vedge-C8000V" ],
+            "factoryDefault": False,
+            "templateMinVersion": "15.0.0",
+            "configType": "xml",
+            "resourceGroup": "global",
+            "templateDefinition": {
+                "if-name": {
+                    "vipObjectType": "object",
+                    "vipType": "variableName",
+                    "vipValue": "",
+                    "vipVariableName": "vpn_if_svi_100_if_name"
+                },
+                "description": {
+                    "vipObjectType": "object",
+                    "vipType": "variableName",
+                    "vipValue": "",
+                    "vipVariableName": "vpn_if_svi_100_description"
+                },
+                "ip": {
+                    "address": {
+                        "vipObjectType": "object",
+                        "vipType": "variableName",
+                        "vipValue": "",
+                        "vipVariableName": "vpn_if_svi_100_if_ipv4_prefix"
+                    }
+                },
+                "shutdown": {
+                    "vipObjectType": "object",
+                    "vipType": "constant",
+                    "vipValue": "false",
+                    "vipVariableName": "vpn_if_svi_shutdown"
+                }
+            }
+        }
+    }],
+    "inputs": {
+        "csv-deviceIP": "10.10.119.{index}",
+        "csv-host-name": "api-test-{index}",
+        "//system/host-name": "api-test-{index}",
+        "//system/system-ip": "10.10.119.{index}",
+        "//system/site-id": "119",
+        "/0/vpn_if_svi_100_if_name/interface/if-name": "Vlan100",
+        "/0/vpn_if_svi_100_if_name/interface/description": "Changed by API",
+        "/0/vpn_if_svi_100_if_name/interface/ip/address": "100.100.100.{index}/24"
+    }
+}
+
 # workflow #1 Commision a new store/branch edge router
-def commission_router(auth):
-    subworkflow_id = commission_router_menu()
-    device_templates = vManage(auth).get_device_templates()
-    device_list = vManage(auth).get_device_list()
+# the arguments of every workflow are asked for interactively unless given, as they are by the batch runner
+def commission_router(auth, subworkflow_id=None, file=None, inventory=None):
+    subworkflow_id = subworkflow_id or commission_router_menu()
+    inventory = Inventory.load(auth) if inventory is None else inventory
     if subworkflow_id == 1:
         # sub-workflow #1 Link templates and get template input variables
-        mapping, file = load_mapping(1)
-        all_template_input = {}
-        for row in mapping:
-            template_name = row["TemplateName"]
-            template_id = next(device_template["templateId"] for device_template in device_templates if device_template["templateName"] == template_name)
-            device_chassis_numbers = row["DeviceChassisNumber"].split(",")
-            device_id_list = [device["uuid"] for device in device_list if device["chasisNumber"] in device_chassis_numbers]
-            template_input_sets = vManage(auth).get_template_input(template_id, device_id_list)
-            for template_input_set in template_input_sets:
-                template_input_set.pop("csv-status", None)
-            write_excel(file, template_name, template_input_sets)
+        mapping, file = load_mapping(1, file)
+        template_names = [row["TemplateName"] for row in mapping]
+        inventory.require(
+            template_names=template_names,
+            chassis_numbers=[chassis_number for row in mapping for chassis_number in split_comma_list(row["DeviceChassisNumber"])]
+        )
+        vmanage = vManage(auth)
+        requests_args = []
+        for template_name, row in zip(template_names, mapping):
+            template_id = inventory.template_by_name(template_name)["templateId"]
+            device_id_list = [device["uuid"] for device in inventory.devices_by_chassis(split_comma_list(row["DeviceChassisNumber"]))]
+            requests_args.append((template_name, vmanage.get_template_input, template_id, device_id_list))
+        all_template_input_sets = vmanage.concurrent_map(time_row, requests_args)
+        with open_workbook(file):
+            for template_name, template_input_sets in zip(template_names, all_template_input_sets):
+                for template_input_set in template_input_sets:
+                    template_input_set.pop("csv-status", None)
+                write_excel(file, template_name, template_input_sets)
 
     elif subworkflow_id == 2:
         # sub-workflow #2 Upload data and get config down to routers
-        mapping, file = load_mapping(1)
+        mapping, file = load_mapping(1, file)
+        inventory.require(template_names=[row["TemplateName"] for row in mapping])
+        # the rows are attached together, so they are not timed one by one
+        template_inputs = []
         for row in mapping:
             template_name = row["TemplateName"]
-            template_id = next(device_template["templateId"] for device_template in device_templates if device_template["templateName"] == template_name)
+            template_id = inventory.template_by_name(template_name)["templateId"]
             template_input_variables = excel_to_json(file, template_name)
-            vManage(auth).attach_template(template_id, template_input_variables)
+            template_inputs.append((template_id, template_input_variables))
+        # routers already attached by an interrupted run are left out
+        journal = RunJournal("commission_router", mapping_hash(file))
+        template_inputs = journal.pending_attach(ActionTracker(auth), template_inputs)
+        vManage(auth).attach_templates(template_inputs, on_action=journal.attach_started)
 
-# workflow #2 Decommission a closed store/branch edge router
-def decommission_router(auth):
-    # sub-workflow #1 detach the router from template (change to cli mode)
-    device_hostname = get_hostname()
-    device_list = vManage(auth).get_device_list()
-    device_details = next(device for device in device_list if "host-name" in device and device["host-name"] == device_hostname)
-    vManage(auth).detach_template(device_details["deviceType"], device_details["uuid"], device_details["deviceIP"])
+# workflow #2 Decommission closed store/branch edge routers
+def decommission_router(auth, hostnames=None, inventory=None):
+    # sub-workflow #1 detach the routers from templates (change to cli mode)
+    device_hostnames = get_hostnames(hostnames)
+    inventory = Inventory.load(auth, templates=False) if inventory is None else inventory
+    inventory.require(hostnames=device_hostnames)
+    devices = [inventory.device_by_hostname(device_hostname) for device_hostname in device_hostnames]
+    vManage(auth).detach_templates(devices)
 
-    # sub-workflow #2 invalidate router certificate
-    vManage(auth).invalidate_certificate(device_details["chasisNumber"], device_details["serialNumber"])
+    # sub-workflow #2 invalidate router certificates in one request
+    vManage(auth).invalidate_certificates([(device["chasisNumber"], device["serialNumber"]) for device in devices])
 
-    # sub-workflow #3 send to controllers
+    # sub-workflow #3 send to controllers once for all routers
     vManage(auth).sync_controllers()
 
 # workflow #3 Replace (RMA) a broken store/branch edge router
-def rma(auth):
-    mapping, file = load_mapping(3)
-    device_list = vManage(auth).get_device_list()
-    for row in mapping:
-        # sub-workflow #1 get old router variables and prepare for new router
-        old_device = next(device for device in device_list if device["chasisNumber"] == row["OldDevice"])
-        new_device = next(device for device in device_list if device["chasisNumber"] == row["NewDevice"])
-        template_input = vManage(auth).get_template_input(old_device["templateId"], [old_device["uuid"]])
+def rma(auth, file=None, inventory=None):
+    mapping, file = load_mapping(3, file)
+    # every finished step is recorded in the run journal, a resumed run skips them
+    journal = RunJournal("rma", mapping_hash(file))
+    removed = {row["OldDevice"] for row in mapping if journal.done("remove", row["OldDevice"])}
+    inventory = Inventory.load(auth, templates=False) if inventory is None else inventory
+    inventory.require(chassis_numbers=[row["OldDevice"] for row in mapping if row["OldDevice"] not in removed] + [row["NewDevice"] for row in mapping])
+    tracker = ActionTracker(auth)
+    vmanage = vManage(auth)
+
+    # sub-workflow #1 get old router variables and prepare for new routers
+    old_devices = {row["OldDevice"]: inventory.device_by_chassis(row["OldDevice"]) for row in mapping if row["OldDevice"] not in removed}
+    pending_rows = [row for row in mapping if not journal.done("input", row["OldDevice"])]
+    all_template_input = vmanage.concurrent_map(time_row, [(row["OldDevice"], vmanage.get_template_input, old_devices[row["OldDevice"]]["templateId"], [old_devices[row["OldDevice"]]["uuid"]]) for row in pending_rows])
+    for row, template_input in zip(pending_rows, all_template_input):
         template_input[0].pop("csv-status", None)
-        template_input[0]["csv-deviceId"] = new_device["uuid"]
-
-        # sub-workflow #2 remove / decommission old router depending on RMAviaTAC flag)
-        if row["RMAviaTAC"] == "Y":
-            vManage(auth).invalidate_certificate(old_device["chasisNumber"], old_device["serialNumber"])
-            sync_controllers_action = vManage(auth).sync_controllers()
-            # NOTE TO CONSIDER IN PRODUCTION: let this action runs for all old devices before checking the status
-            # so that this checking of action status does not block the app runtime
-            sync_controllers_action_status = "in_progress"
-            while not sync_controllers_action_status == "done":
-                time.sleep(2)
-                sync_controllers_action_status = vManage(auth).track_action_status(sync_controllers_action["id"])
-            vManage(auth).completely_remove_device(old_device["uuid"])
-        else:
-            decommission_router_action = vManage(auth).decommission_device(old_device["uuid"])
-            vManage(auth).invalidate_certificate(old_device["chasisNumber"], old_device["serialNumber"])
-            sync_controllers_action = vManage(auth).sync_controllers()
+        template_input[0]["csv-deviceId"] = inventory.device_by_chassis(row["NewDevice"])["uuid"]
+        journal.record("input", row["OldDevice"], templateId=old_devices[row["OldDevice"]]["templateId"], values=template_input[0])
+    template_inputs = [(journal.entry("input", row["OldDevice"])["templateId"], [journal.entry("input", row["OldDevice"])["values"]]) for row in mapping]
 
-        # sub-workflow #3 attach new router to template
-        attach_template_action = vManage(auth).attach_template(old_device["templateId"], template_input)
+    # sub-workflow #2 remove / decommission old routers depending on RMAviaTAC flag
+    # decommission RMAviaTAC=N routers, invalidate all old certificates in one request and sync controllers once
+    removed_rows = [row for row in mapping if row["RMAviaTAC"] == "Y" and row["OldDevice"] not in removed]
+    decommissioned_rows = [row for row in mapping if row["RMAviaTAC"] != "Y" and not journal.done("decommission", row["OldDevice"])]
+    def decommission(chassis_number):
+        vmanage.decommission_device(old_devices[chassis_number]["uuid"])
+        journal.record("decommission", chassis_number)
+    vmanage.concurrent_map(decommission, [(row["OldDevice"],) for row in decommissioned_rows])
+    if not journal.done("invalidate"):
+        vmanage.invalidate_certificates([(old_device["chasisNumber"], old_device["serialNumber"]) for old_device in old_devices.values()])
+        journal.record("invalidate")
+    sync_controllers = journal.run_action(tracker, "sync", "sync", lambda: vmanage.sync_controllers()["id"])
+    # RMAviaTAC=Y routers are removed from vManage once the controllers know their certificates are invalid
+    def remove(chassis_number):
+        vmanage.completely_remove_device(old_devices[chassis_number]["uuid"])
+        journal.record("remove", chassis_number)
+    if sync_controllers == "success":
+        vmanage.concurrent_map(remove, [(row["OldDevice"],) for row in removed_rows])
+    elif removed_rows:
+        print(f"Controller sync {journal.entry('sync')['actionId']} ended with {sync_controllers}, routers not removed: {', '.join(row['OldDevice'] for row in removed_rows)}")
+
+    # sub-workflow #3 attach new routers to templates, grouped by template in chunked requests
+    template_inputs = journal.pending_attach(tracker, template_inputs)
+    attach_template_actions = vmanage.attach_templates(template_inputs, on_action=journal.attach_started)
+    for action_id in attach_template_actions:
+        journal.track(tracker, action_id, "attach")
+    results = tracker.wait_all(attach_template_actions)
+    for action_id, action in results.items():
+        print(f"Attach action {action_id}: {action['state']}")
 
 # workflow #4 Store reclassification
-def store_reclassification(auth):
-    subworkflow_id = reclassification_menu()
-    device_templates = vManage(auth).get_device_templates()
-    device_list = vManage(auth).get_device_list()
+def store_reclassification(auth, subworkflow_id=None, file=None, inventory=None):
+    subworkflow_id = subworkflow_id or reclassification_menu()
+    inventory = Inventory.load(auth) if inventory is None else inventory
     if subworkflow_id == 1:
         # sub-workflow #1 Specify routers and templates
-        mapping, file = load_mapping(4)
-        all_template_input = {}
-        for row in mapping:
-            template_name = row["TemplateName"]
-            template_id = next(device_template["templateId"] for device_template in device_templates if device_template["templateName"] == template_name)
-            device_chassis_numbers = row["DeviceChassisNumber"].split(",")
-            device_id_list = [device["uuid"] for device in device_list if device["chasisNumber"] in device_chassis_numbers]
-            template_input_sets = vManage(auth).get_template_input(template_id, device_id_list)
-            #print(template_input_sets)
-            for template_input_set in template_input_sets:
-                template_input_set.pop("csv-status", None)
-            write_excel(file, template_name, template_input_sets)
+        mapping, file = load_mapping(4, file)
+        template_names = [row["TemplateName"] for row in mapping]
+        inventory.require(
+            template_names=template_names,
+            chassis_numbers=[chassis_number for row in mapping for chassis_number in split_comma_list(row["DeviceChassisNumber"])]
+        )
+        vmanage = vManage(auth)
+        requests_args = []
+        for template_name, row in zip(template_names, mapping):
+            template_id = inventory.template_by_name(template_name)["templateId"]
+            device_id_list = [device["uuid"] for device in inventory.devices_by_chassis(split_comma_list(row["DeviceChassisNumber"]))]
+            requests_args.append((row["DeviceChassisNumber"], vmanage.get_template_input, template_id, device_id_list))
+        all_template_input_sets = vmanage.concurrent_map(time_row, requests_args)
+        with open_workbook(file):
+            for template_name, template_input_sets in zip(template_names, all_template_input_sets):
+                #print(template_input_sets)
+                for template_input_set in template_input_sets:
+                    template_input_set.pop("csv-status", None)
+                write_excel(file, template_name, template_input_sets)
 
     elif subworkflow_id == 2:
         # sub-workflow #2 Upload data and reattach routers
-        mapping, file = load_mapping(4)
+        mapping, file = load_mapping(4, file)
+        inventory.require(template_names=[row["TemplateName"] for row in mapping])
+        # the rows are diffed and attached together, so they are not timed one by one
+        template_inputs = []
         for row in mapping:
             template_name = row["TemplateName"]
-            template_id = next(device_template["templateId"] for device_template in device_templates if device_template["templateName"] == template_name)
+            template_id = inventory.template_by_name(template_name)["templateId"]
             template_input_variables = excel_to_json(file, template_name)
-            vManage(auth).attach_template(template_id, template_input_variables)
+            template_inputs.append((template_id, template_input_variables))
+        # every row reads the whole template sheet, so a router is listed once per row using it
+        template_inputs = unique_template_inputs(template_inputs)
+        if diff_mode or dry_run:
+            template_inputs = changed_template_inputs(auth, template_inputs, {device["uuid"]: device.get("templateId") for device in inventory.device_list})
+        if not dry_run:
+            # only routers whose attach succeeded are recorded as deployed
+            record_template_inputs(template_inputs, attach_and_confirm(auth, template_inputs))
 
 # workflow #5 Configure changes to existing store/branch edge routers
-def configure_changes(auth):
+def configure_changes(auth, template_name=None, changes_file=None, inventory=None):
     # sub-workflow #1 copy an existing template and make changes
-    template_name = get_template_name()
-    device_templates = vManage(auth).get_device_templates()
-    template_id = next(device_template["templateId"] for device_template in device_templates if device_template["templateName"] == template_name)
+    template_name = get_template_name(template_name)
+    inventory = Inventory.load(auth, devices=False) if inventory is None else inventory
+    inventory.require(template_names=[template_name])
+    template_id = inventory.template_by_name(template_name)["templateId"]
+    template_changes = load_template_changes(changes_file)
     device_template_config = vManage(auth).get_template_config(template_id)
     device_template_config.pop("templateId", None)
-    device_template_config["templateName"] += "-Changed"
-    device_template_config["templateDescription"] += "-Changed"
-    # NOTE: hard coded template changes
-    new_feature_template = {
-        "templateName": "C8000v-Alvin-Test-SVI-100",
-        "templateDescription": "C8000v-Alvin-Test-SVI-100",
-        "templateType": "vpn-interface-svi",
-        "deviceType": [ "vedge-C8000V" ],
-        "factoryDefault": False,
-        "templateMinVersion": "15.0.0",
-        "configType": "xml",
-        "resourceGroup": "global",
-        "templateDefinition": {
-            "if-name": {
-                "vipObjectType": "object",
-                "vipType": "variableName",
-                "vipValue": "",
-                "vipVariableName": "vpn_if_svi_100_if_name"
-            },
-            "description": {
-                "vipObjectType": "object",
-                "vipType": "variableName",
-                "vipValue": "",
-                "vipVariableName": "vpn_if_svi_100_description"
-            },
-            "ip": {
-                "address": {
-                    "vipObjectType": "object",
-                    "vipType": "variableName",
-                    "vipValue": "",
-                    "vipVariableName": "vpn_if_svi_100_if_ipv4_prefix"
-                }
-            },
-            "shutdown": {
-                "vipObjectType": "object",
-                "vipType": "constant",
-                "vipValue": "false",
-                "vipVariableName": "vpn_if_svi_shutdown"
-            }
-        }
-    }
-    new_feature_template_id = vManage(auth).add_feature_template(new_feature_template)
-    for template in device_template_config["generalTemplates"]:
-        if template["templateType"] == "cisco_vpn" and "subTemplates" in template:
-            template["subTemplates"].append({
-                "templateId": new_feature_template_id,
-                "templateType": "vpn-interface-svi"
-            })
-    new_device_template_id = vManage(auth).add_device_template(device_template_config)
+    device_template_config["templateName"] += template_changes["nameSuffix"]
+    device_template_config["templateDescription"] += template_changes["nameSuffix"]
+    # feature and device templates identical to existing ones are reused instead of created again
+    registry = TemplateRegistry(auth)
+    for feature_template in template_changes["featureTemplates"]:
+        new_feature_template_id = registry.ensure_feature_template(feature_template["template"])
+        for template in device_template_config["generalTemplates"]:
+            if template["templateType"] == feature_template["parentTemplateType"] and "subTemplates" in template:
+                template["subTemplates"].append({
+                    "templateId": new_feature_template_id,
+                    "templateType": feature_template["template"]["templateType"]
+                })
+    new_device_template_id = registry.ensure_device_template(device_template_config)
 
     # sub-workflow #2 deploy changes to routers in batches
-    attached_devices = vManage(auth).get_template_attached_devices(template_id)
-    last_octet = 1
-    for device in attached_devices:
-        template_inputs = vManage(auth).get_template_input(new_device_template_id, [device["uuid"]])
-        template_inputs[0].pop("csv-status", None)
-        template_inputs[0]["csv-deviceIP"] = f"10.10.119.{last_octet}"
-        template_inputs[0]["csv-host-name"] = f"api-test-{last_octet}"
-        template_inputs[0]["//system/host-name"] = f"api-test-{last_octet}"
-        template_inputs[0]["//system/system-ip"] = f"10.10.119.{last_octet}"
-        template_inputs[0]["//system/site-id"] = f"119"
-        template_inputs[0]["/0/vpn_if_svi_100_if_name/interface/if-name"] = "Vlan100"
-        template_inputs[0]["/0/vpn_if_svi_100_if_name/interface/description"] = f"Changed by API"
-        template_inputs[0]["/0/vpn_if_svi_100_if_name/interface/ip/address"] = f"100.100.100.{last_octet}/24"
-        vManage(auth).attach_template(new_device_template_id, template_inputs)
-        print(f"Deployed changes to {last_octet} device(s)")
-        last_octet += 1
-        time.sleep(60)
+    # the routers and their input values are kept in the run journal, as routers leave the original template once deployed
+    journal = RunJournal("configure_changes", hashlib.sha256(json.dumps([template_name, template_changes], sort_keys=True).encode()).hexdigest())
+    if not journal.done("inputs"):
+        attached_devices = vManage(auth).get_template_attached_devices(template_id)
+        vmanage = vManage(auth)
+        all_template_inputs = vmanage.concurrent_map(vmanage.get_template_input, [(new_device_template_id, [device["uuid"]]) for device in attached_devices])
+        last_octet = 1
+        for template_inputs in all_template_inputs:
+            template_inputs[0].pop("csv-status", None)
+            for variable, value in template_changes["inputs"].items():
+                template_inputs[0][variable] = value.format(index=last_octet)
+            last_octet += 1
+        journal.record("inputs", values=[template_inputs[0] for template_inputs in all_template_inputs])
+    rollout_inputs = [(new_device_template_id, journal.entry("inputs")["values"])]
+    if diff_mode or dry_run:
+        # routers move from the original template to its changed copy, so their values are compared to the ones under the original
+        rollout_inputs = changed_template_inputs(auth, rollout_inputs, {values["csv-deviceId"]: template_id for values in rollout_inputs[0][1]}, template_moves=False)
+    if not dry_run and rollout_inputs:
+        # canary first, then growing waves, each started as soon as the previous one has been pushed,
+        # routers already deployed by an interrupted run are left out
+        pending_inputs = journal.pending_attach(ActionTracker(auth), rollout_inputs)
+        rollout = RolloutScheduler(auth).run(new_device_template_id, pending_inputs[0][1] if pending_inputs else [], journal)
+        # routers whose attach succeeded, in this run or the interrupted one, are recorded as deployed
+        deployed = rollout["succeeded"] | {values["csv-deviceId"] for values in rollout_inputs[0][1] if journal.done("attach", values["csv-deviceId"])}
+        record_template_inputs(rollout_inputs, deployed)
 
 # initiated user selected workflow
 def workflow_starter(id):
+    metrics.reset()
+    auth = vManage(None).authentication()
+    try:
+        if id == 1:
+            commission_router(auth)
+        elif id == 2:
+            decommission_router(auth)
+        elif id == 3:
+            rma(auth)
+        elif id == 4:
+            store_reclassification(auth)
+        elif id == 5:
+            configure_changes(auth)
+    finally:
+        flush_response_cache()
+        print(metrics.summary())
+        if metrics_export:
+            metrics.export(metrics_export)
+
+# run the jobs of a job file under one vManage session
+def batch_starter(job_file):
+    metrics.reset()
+    jobs = load_job_file(job_file)
     auth = vManage(None).authentication()
-    if id == 1:
-        commission_router(auth)
-    elif id == 2:
-        decommission_router(auth)
-    elif id == 3:
-        rma(auth)
-    elif id == 4:
-        store_reclassification(auth)
-    elif id == 5:
-        configure_changes(auth)
+    try:
+        return BatchRunner(auth, jobs).run()
+    finally:
+        flush_response_cache()
+        print(metrics.summary())
+        if metrics_export:
+            metrics.export(metrics_export)
 
 # display menu for choosing sub-workflow of commission_router
 def commission_router_menu():
@@ -257,42 +426,48 @@ def reclassification_menu():
 
 # convert a excel sheet to json
 def excel_to_json(file, sheet_name):
-    excel_df = pd.read_excel(file, sheet_name=sheet_name)
-    excel_json = json.loads(excel_df.to_json(orient="records"))
-    return excel_json
+    with metrics.span("workbook", "excel_to_json"):
+        return open_workbook(file).read(sheet_name)
 
-# write data to excel
+# write data to excel, written straight away unless the workbook session is batching writes
 def write_excel(file, sheet_name, data):
-    writer = pd.ExcelWriter(file, engine="openpyxl", mode="a", if_sheet_exists="replace")
-    fileb = open(file, "rb")
-    writer.book = openpyxl.load_workbook(fileb)
-    writer.sheets = dict((ws.title, ws) for ws in writer.book.worksheets)
-    df = pd.DataFrame(data)
-    df.to_excel(writer, sheet_name=sheet_name, index=False)
-    writer.close()
+    with metrics.span("workbook", "write_excel"):
+        workbook = open_workbook(file)
+        workbook.write(sheet_name, data)
+        if not workbook.deferred:
+            workbook.flush()
 
 # load mapping file
-def load_mapping(workflow):
-    print()
-    file = input("Please provide the name of your mapping file: ")
+def load_mapping(workflow, file=None):
+    if file is None:
+        print()
+        file = input("Please provide the name of your mapping file: ")
     if workflow == 1:
         mapping = excel_to_json(file, "Commission")
+    elif workflow == 2:
+        mapping = excel_to_json(file, "Decommission")
     elif workflow == 3:
         mapping = excel_to_json(file, "RMA")
     elif workflow == 4:
         mapping = excel_to_json(file, "Reclassification")
     return mapping, file
 
-# get hostname from user input
-def get_hostname():
-    print()
-    hostname = input("Please provide the hostname of router: ")
-    return hostname
+# get hostnames from user input, comma separated or from the Decommission sheet of a mapping file
+def get_hostnames(hostnames=None):
+    if hostnames is None:
+        print()
+        hostnames = input("Please provide the hostname(s) of router, comma separated, or a mapping file: ")
+    if isinstance(hostnames, list):
+        return hostnames
+    if os.path.exists(hostnames):
+        return [row["HostName"] for row in excel_to_json(hostnames, "Decommission")]
+    return split_comma_list(hostnames)
 
 # get template name from user input
-def get_template_name():
-    print()
-    template_name = input("Please provide the template name: ")
+def get_template_name(template_name=None):
+    if template_name is None:
+        print()
+        template_name = input("Please provide the template name: ")
     return template_name
 
 # add template config via vManage SDK
@@ -309,14 +484,1530 @@ def menu():
     workflow_id = input("Which workflow do you want to start? ")
     workflow_starter(int(workflow_id))
 
+# load and check the jobs of a YAML or JSON job file, a list of jobs or a mapping with a "jobs" list
+def load_job_file(path):
+    with open(path) as file:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            import yaml
+            jobs = yaml.safe_load(file)
+        else:
+            jobs = json.load(file)
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [])
+    required = {
+        "commission": ("subworkflow", "mapping"),
+        "decommission": ("hostnames",),
+        "rma": ("mapping",),
+        "reclassification": ("subworkflow", "mapping"),
+        "configure_changes": ("template",)
+    }
+    for number, job in enumerate(jobs, start=1):
+        job.setdefault("name", f"job {number}")
+        if job.get("workflow") not in workflow_ids:
+            raise ValueError(f"{job['name']}: unknown workflow {job.get('workflow')!r}, expected one of {', '.join(workflow_ids)}")
+        missing = [key for key in required[job["workflow"]] if key not in job]
+        if missing:
+            raise ValueError(f"{job['name']}: {job['workflow']} needs {', '.join(missing)}")
+    return jobs
+
+# define a class for running batch jobs without prompts: jobs run in the order of the job file,
+# jobs touching disjoint routers, mapping files and templates run in parallel, and jobs after
+# a job they overlap with wait for it, or are skipped if it failed
+class BatchRunner():
+    def __init__(self, auth, jobs, max_parallel_jobs=None):
+        self.auth = auth
+        self.jobs = jobs
+        self.max_parallel_jobs = batch_max_parallel_jobs if max_parallel_jobs is None else max_parallel_jobs
+
+    # add the routers, mapping file and templates a job works on to resources, routers by uuid;
+    # what was added before an error, e.g. the mapping file, is kept
+    def add_resources(self, job, inventory, resources):
+        workflow = job["workflow"]
+        sheet_name = {"commission": "Commission", "rma": "RMA", "reclassification": "Reclassification"}.get(workflow)
+        if sheet_name:
+            resources.add(f"file:{os.path.abspath(job['mapping'])}")
+            mapping = excel_to_json(job["mapping"], sheet_name)
+        if workflow in ("commission", "reclassification"):
+            chassis_numbers = [chassis_number for row in mapping for chassis_number in split_comma_list(row["DeviceChassisNumber"])]
+        elif workflow == "rma":
+            chassis_numbers = [row[column] for row in mapping for column in ("OldDevice", "NewDevice")]
+        else:
+            chassis_numbers = []
+        resources.update(f"device:{inventory.indexes['chassis number'][chassis_number]['uuid']}" for chassis_number in chassis_numbers if chassis_number in inventory.indexes["chassis number"])
+        if workflow == "decommission":
+            if isinstance(job["hostnames"], str) and os.path.exists(job["hostnames"]):
+                resources.add(f"file:{os.path.abspath(job['hostnames'])}")
+            resources.update(f"device:{inventory.indexes['hostname'][hostname]['uuid']}" for hostname in get_hostnames(job["hostnames"]) if hostname in inventory.indexes["hostname"])
+        if workflow == "configure_changes":
+            template = inventory.indexes["template name"].get(job["template"], {})
+            resources.update(f"device:{device['uuid']}" for device in inventory.device_list if template and device.get("templateId") == template["templateId"])
+            # new feature and device templates are created by one job at a time
+            resources.add("templates")
+
+    # group the jobs into levels run one after another, each job one level after the last earlier job it overlaps;
+    # returns the resources of every job, the levels, and the errors of jobs whose resources could not be read
+    def plan(self, inventory):
+        resources = []
+        errors = {}
+        for number, job in enumerate(self.jobs):
+            job_resources = set()
+            try:
+                self.add_resources(job, inventory, job_resources)
+            except Exception as error:
+                errors[number] = f"{type(error).__name__}: {error}"
+            resources.append(job_resources)
+        levels = []
+        for number, job_resources in enumerate(resources):
+            level = max((levels[earlier] + 1 for earlier in range(number) if resources[earlier] & job_resources), default=0)
+            levels.append(level)
+        return resources, [[number for number, level in enumerate(levels) if level == current] for current in range(max(levels, default=-1) + 1)], errors
+
+    def run_job(self, job, inventory):
+        workflow = job["workflow"]
+        if workflow == "commission":
+            commission_router(self.auth, int(job["subworkflow"]), job["mapping"], inventory)
+        elif workflow == "decommission":
+            decommission_router(self.auth, job["hostnames"], inventory)
+        elif workflow == "rma":
+            rma(self.auth, job["mapping"], inventory)
+        elif workflow == "reclassification":
+            store_reclassification(self.auth, int(job["subworkflow"]), job["mapping"], inventory)
+        elif workflow == "configure_changes":
+            configure_changes(self.auth, job["template"], job.get("changes"), inventory)
+
+    def run_timed(self, job, inventory):
+        started = time.time()
+        try:
+            self.run_job(job, inventory)
+            return {"name": job["name"], "status": "success", "seconds": time.time() - started}
+        except Exception as error:
+            return {"name": job["name"], "status": "failure", "seconds": time.time() - started, "error": f"{type(error).__name__}: {error}"}
+
+    # run every job, returns the result of each in job file order
+    def run(self):
+        # one inventory snapshot shared by the jobs of a level, downloaded again for later levels
+        # as the jobs before them changed the routers they overlap with
+        inventory = Inventory.load(self.auth)
+        resources, levels, errors = self.plan(inventory)
+        results = [None] * len(self.jobs)
+        blocked = set()
+        for level_number, level in enumerate(levels):
+            if level_number:
+                inventory = Inventory.load(self.auth)
+            runnable = []
+            for number in level:
+                if number in errors:
+                    results[number] = {"name": self.jobs[number]["name"], "status": "failure", "seconds": 0, "error": errors[number]}
+                elif resources[number] & blocked:
+                    results[number] = {"name": self.jobs[number]["name"], "status": "skipped", "seconds": 0, "error": "overlaps a job that did not succeed"}
+                else:
+                    runnable.append(number)
+            with ThreadPoolExecutor(max_workers=max(min(self.max_parallel_jobs, len(runnable)), 1)) as executor:
+                for number, result in zip(runnable, executor.map(lambda number: self.run_timed(self.jobs[number], inventory), runnable)):
+                    results[number] = result
+            for number in level:
+                if results[number]["status"] != "success":
+                    blocked |= resources[number]
+        print()
+        for job, result in zip(self.jobs, results):
+            error = f" - {result['error']}" if "error" in result else ""
+            print(f"Job {result['name']} ({job['workflow']}): {result['status']} in {result['seconds']:.1f}s{error}")
+        return results
+
+# shared mapping stores, one per mapping file or directory
+workbook_sessions = {}
+
+# get the shared mapping store of a path: an excel workbook for .xlsx/.xlsm files,
+# otherwise a directory with one CSV or Parquet file per sheet
+def open_workbook(file):
+    path = os.path.abspath(file)
+    if path not in workbook_sessions:
+        if os.path.splitext(path)[1].lower() in (".xlsx", ".xlsm"):
+            workbook_sessions[path] = WorkbookSession(file)
+        else:
+            workbook_sessions[path] = MappingDirectory(file)
+    return workbook_sessions[path]
+
+# copy every sheet of a mapping file or directory to another format
+def convert_mapping(source, destination):
+    source_store = open_workbook(source)
+    with open_workbook(destination) as destination_store:
+        for sheet_name in source_store.sheet_names():
+            destination_store.write(sheet_name, source_store.read(sheet_name))
+
+# define a base class for mapping stores, caching sheets read as records and
+# accumulating sheet writes to save them together
+class MappingStore():
+    def __init__(self, file):
+        self.file = file
+        self.mtime = None
+        self.records = {}
+        self.pending = {}
+        self.deferred = 0
+
+    # defer writes inside a with block and save them in one go at the end
+    def __enter__(self):
+        self.deferred += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.deferred -= 1
+        if not self.deferred:
+            self.flush()
+
+    # sheet rows as a list of records keyed by the header row
+    def read(self, sheet_name):
+        if sheet_name in self.pending:
+            return [dict(record) for record in self.pending[sheet_name]]
+        self.check_modified()
+        if sheet_name not in self.records:
+            self.records[sheet_name] = self.load_sheet(sheet_name)
+        return [dict(record) for record in self.records[sheet_name]]
+
+    # queue a sheet replacement, records are padded to the same columns as when read back
+    def write(self, sheet_name, records):
+        columns = list(dict.fromkeys(key for record in records for key in record))
+        self.pending[sheet_name] = [{column: record.get(column) for column in columns} for record in records]
+
+    # save all pending sheets together
+    def flush(self):
+        if not self.pending:
+            return
+        self.close()
+        with metrics.span("workbook", "flush"):
+            self.save_sheets(self.pending)
+        self.records.update(self.pending)
+        self.pending = {}
+        self.mtime = self.modified_time()
+
+    # drop cached sheets when the file was changed outside this session
+    def check_modified(self):
+        mtime = self.modified_time()
+        if self.mtime != mtime:
+            self.close()
+            self.records = {}
+            self.mtime = mtime
+
+    def close(self):
+        pass
+
+# define a class for a mapping workbook opened once, with sheets streamed in read-only mode
+# and sheet writes saved with a single workbook save
+class WorkbookSession(MappingStore):
+    def __init__(self, file):
+        super().__init__(file)
+        self.reader = None
+
+    def sheet_names(self):
+        self.check_modified()
+        return list(dict.fromkeys(self.open_reader().sheetnames + list(self.pending)))
+
+    # openpyxl is imported on first use, workflows without a workbook never load it
+    def open_reader(self):
+        if self.reader is None:
+            import openpyxl
+            self.reader = openpyxl.load_workbook(self.file, read_only=True, data_only=True)
+        return self.reader
+
+    def load_sheet(self, sheet_name):
+        rows = self.open_reader()[sheet_name].iter_rows(values_only=True)
+        header = next(rows, ())
+        columns = [f"Unnamed: {i}" if column is None else str(column) for i, column in enumerate(header)]
+        return [dict(zip(columns, row)) for row in rows if any(value is not None for value in row)]
+
+    def save_sheets(self, sheets):
+        import openpyxl
+        if os.path.exists(self.file):
+            workbook = openpyxl.load_workbook(self.file)
+            for sheet_name, records in sheets.items():
+                if sheet_name in workbook.sheetnames:
+                    index = workbook.sheetnames.index(sheet_name)
+                    workbook.remove(workbook[sheet_name])
+                    worksheet = workbook.create_sheet(sheet_name, index)
+                else:
+                    worksheet = workbook.create_sheet(sheet_name)
+                for row in records_to_rows(records):
+                    worksheet.append(row)
+        else:
+            workbook = openpyxl.Workbook(write_only=True)
+            for sheet_name, records in sheets.items():
+                worksheet = workbook.create_sheet(sheet_name)
+                for row in records_to_rows(records):
+                    worksheet.append(row)
+        workbook.save(self.file)
+
+    def modified_time(self):
+        return os.path.getmtime(self.file) if os.path.exists(self.file) else None
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+# define a class for a mapping directory with one <sheet>.csv or <sheet>.parquet file per sheet
+# new sheets use the format already in the directory, or Parquet for a directory named *.parquet, CSV otherwise
+class MappingDirectory(MappingStore):
+    formats = (".csv", ".parquet")
+
+    def sheet_files(self):
+        if not os.path.isdir(self.file):
+            return {}
+        return {os.path.splitext(name)[0]: name for name in sorted(os.listdir(self.file)) if os.path.splitext(name)[1].lower() in self.formats}
+
+    def sheet_names(self):
+        return list(dict.fromkeys(list(self.sheet_files()) + list(self.pending)))
+
+    def sheet_format(self, sheet_name):
+        sheet_files = self.sheet_files()
+        if sheet_name in sheet_files:
+            return os.path.splitext(sheet_files[sheet_name])[1].lower()
+        extensions = [os.path.splitext(name)[1].lower() for name in sheet_files.values()]
+        if not extensions:
+            return ".parquet" if self.file.rstrip(os.sep).lower().endswith(".parquet") else ".csv"
+        return ".parquet" if all(extension == ".parquet" for extension in extensions) else ".csv"
+
+    def load_sheet(self, sheet_name):
+        sheet_files = self.sheet_files()
+        if sheet_name not in sheet_files:
+            raise KeyError(f"Worksheet {sheet_name} does not exist.")
+        path = os.path.join(self.file, sheet_files[sheet_name])
+        if self.sheet_format(sheet_name) == ".parquet":
+            import pyarrow.parquet
+            return pyarrow.parquet.read_table(path).to_pylist()
+        with open(path, newline="", encoding="utf-8") as sheet_file:
+            return [{column: value if value != "" else None for column, value in row.items()} for row in csv.DictReader(sheet_file)]
+
+    def save_sheets(self, sheets):
+        os.makedirs(self.file, exist_ok=True)
+        for sheet_name, records in sheets.items():
+            extension = self.sheet_format(sheet_name)
+            path = os.path.join(self.file, sheet_name + extension)
+            rows = records_to_rows(records)
+            columns = next(rows)
+            if extension == ".parquet":
+                import pyarrow, pyarrow.parquet
+                # values are stored as text like in CSV, so mixed-type columns from excel still convert
+                table = pyarrow.table({column: pyarrow.array([None if record[column] is None else str(record[column]) for record in records], pyarrow.string()) for column in columns})
+                pyarrow.parquet.write_table(table, path)
+            else:
+                with open(path, "w", newline="", encoding="utf-8") as sheet_file:
+                    writer = csv.writer(sheet_file)
+                    writer.writerow(columns)
+                    writer.writerows(rows)
+
+    def modified_time(self):
+        sheet_files = self.sheet_files()
+        return max((os.path.getmtime(os.path.join(self.file, name)) for name in sheet_files.values()), default=None)
+
+# header row and value rows of a list of records
+def records_to_rows(records):
+    columns = list(records[0]) if records else []
+    yield columns
+    for record in records:
+        yield [record[column] for column in columns]
+
+# template input value as compared between vManage and the mapping file, where numbers may come back as floats
+def normalize_input_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# variables whose values differ between the current and the desired template inputs, as {variable: (current, desired)}
+def diff_template_input(current, desired):
+    changes = {}
+    for variable in dict.fromkeys(list(current) + list(desired)):
+        if variable != "csv-status" and normalize_input_value(current.get(variable)) != normalize_input_value(desired.get(variable)):
+            changes[variable] = (current.get(variable), desired.get(variable))
+    return changes
+
+# current template input values per (template id, device id), read from the local snapshot if set
+def load_input_snapshot():
+    if not input_snapshot_file or not os.path.exists(input_snapshot_file):
+        return {}
+    with open(input_snapshot_file) as file:
+        snapshot = json.load(file)
+    return {(template_id, device_id): values for template_id, devices in snapshot.items() for device_id, values in devices.items()}
+
+# store the template inputs just attached in the local snapshot, only for the given routers if device_ids is set
+def record_template_inputs(template_inputs, device_ids=None):
+    if not input_snapshot_file:
+        return
+    snapshot = {}
+    for (template_id, device_id), values in load_input_snapshot().items():
+        snapshot.setdefault(template_id, {})[device_id] = values
+    for template_id, template_input_variables in template_inputs:
+        for device in template_input_variables:
+            if device_ids is None or device["csv-deviceId"] in device_ids:
+                snapshot.setdefault(template_id, {})[device["csv-deviceId"]] = {variable: value for variable, value in device.items() if variable != "csv-status"}
+    with open(input_snapshot_file, "w") as file:
+        json.dump(snapshot, file)
+
+# keep only the routers whose template or template input values change, printing the per-device variable diffs
+# current_templates maps device ids to the template each router is attached to now, whose values are compared;
+# with template_moves a router moving to another template is always kept, without it only its values count,
+# as for a template replaced by its changed copy
+def changed_template_inputs(auth, template_inputs, current_templates, template_moves=True):
+    snapshot = load_input_snapshot()
+    current_inputs = {}
+    missing = {}
+    for template_id, template_input_variables in template_inputs:
+        for device in template_input_variables:
+            device_id = device["csv-deviceId"]
+            current_template_id = current_templates.get(device_id)
+            if current_template_id is None:
+                continue
+            if (current_template_id, device_id) in snapshot:
+                current_inputs[(current_template_id, device_id)] = snapshot[(current_template_id, device_id)]
+            else:
+                missing.setdefault(current_template_id, {})[device_id] = None
+    # the values deployed now decide which routers are skipped, so they are not served from the response cache
+    fetches = [(current_template_id, list(device_ids), True) for current_template_id, device_ids in missing.items()]
+    vmanage = vManage(auth)
+    for (current_template_id, device_ids, refresh), fetched in zip(fetches, vmanage.concurrent_map(vmanage.get_template_input, fetches)):
+        for values in fetched:
+            current_inputs[(current_template_id, values["csv-deviceId"])] = values
+
+    changed_inputs = []
+    unchanged = 0
+    for template_id, template_input_variables in template_inputs:
+        changed_devices = []
+        for device in template_input_variables:
+            device_id = device["csv-deviceId"]
+            current_template_id = current_templates.get(device_id)
+            moved = current_template_id != template_id
+            changes = diff_template_input(current_inputs.get((current_template_id, device_id), {}), device) if current_template_id else {}
+            if not changes and not (moved and (template_moves or current_template_id is None)):
+                unchanged += 1
+                continue
+            print(f"{device.get('csv-host-name', device_id)}:" + (f" template {current_template_id} -> {template_id}" if moved else ""))
+            for variable, (current, desired) in changes.items():
+                print(f"    {variable}: {current!r} -> {desired!r}")
+            changed_devices.append(device)
+        if changed_devices:
+            changed_inputs.append((template_id, changed_devices))
+    print(f"{sum(len(devices) for template_id, devices in changed_inputs)} router(s) to reattach, {unchanged} unchanged")
+    return changed_inputs
+
+# attach template inputs and wait for the attach actions, returns the ids of the routers whose attach action succeeded
+def attach_and_confirm(auth, template_inputs):
+    tracker = ActionTracker(auth)
+    action_devices = {}
+    def started(action_id, device_template_list):
+        action_devices[action_id] = {device["csv-deviceId"] for device_template in device_template_list for device in device_template["device"]}
+    action_ids = vManage(auth).attach_templates(template_inputs, on_action=started)
+    for action_id in action_ids:
+        tracker.add(action_id, "attach")
+    succeeded = set()
+    for action_id, action in tracker.wait_all(action_ids).items():
+        print(f"Attach action {action_id}: {action['state']}")
+        if action["state"] == "success":
+            succeeded |= action_devices[action_id]
+    return succeeded
+
+# template changes for configure_changes, from a JSON file, the TEMPLATE_CHANGES_FILE or the defaults
+def load_template_changes(changes_file=None):
+    changes_file = changes_file or template_changes_file
+    if not changes_file:
+        return json.loads(json.dumps(default_template_changes))
+    with open(changes_file) as file:
+        return dict(json.loads(json.dumps(default_template_changes)), **json.load(file))
+
+# define a class for content-addressed feature and device templates, built from one listing of each,
+# reusing an existing template with identical content instead of creating a duplicate
+class TemplateRegistry():
+    # fields that make up template content, names and descriptions are not part of it
+    feature_fields = ("templateType", "deviceType", "factoryDefault", "templateMinVersion", "configType", "templateDefinition")
+    device_fields = ("deviceType", "configType", "factoryDefault", "policyId", "featureTemplateUidRange", "generalTemplates")
+    # listed fields a template with the same content has in common, to pick the definitions worth fetching
+    candidate_fields = {
+        "feature": ("templateType",),
+        "device": ("deviceType", "configType")
+    }
+
+    def __init__(self, auth):
+        self.auth = auth
+        vmanage = vManage(auth)
+        self.templates = {
+            "feature": {template["templateName"]: template for template in vmanage.get_feature_templates()},
+            "device": {template["templateName"]: template for template in vmanage.get_device_templates()}
+        }
+        self.hashes = {}
+        self.indexed = set()
+        for template in self.templates["feature"].values():
+            if "templateDefinition" in template:
+                self.hashes.setdefault(("feature", self.template_hash("feature", template)), template["templateId"])
+                self.indexed.add(template["templateId"])
+
+    # hash the existing templates that could have the same content under another name, from their full
+    # definitions; the listings leave them out, and the fetched definitions are kept in the response cache
+    def index_candidates(self, kind, template):
+        candidates = [listed["templateId"] for listed in self.templates[kind].values()
+            if listed["templateId"] not in self.indexed and all(listed.get(field) == template.get(field) for field in self.candidate_fields[kind])]
+        vmanage = vManage(self.auth)
+        fetch = vmanage.get_feature_template_config if kind == "feature" else vmanage.get_template_config
+        for template_id, definition in zip(candidates, vmanage.concurrent_map(fetch, [(template_id,) for template_id in candidates])):
+            self.hashes.setdefault((kind, self.template_hash(kind, definition)), template_id)
+            self.indexed.add(template_id)
+
+    # sha256 of the canonical JSON of the template content
+    def template_hash(self, kind, template):
+        fields = self.feature_fields if kind == "feature" else self.device_fields
+        content = {field: template.get(field) for field in fields}
+        if isinstance(content["deviceType"], list):
+            content["deviceType"] = sorted(content["deviceType"])
+        if kind == "device":
+            content["generalTemplates"] = canonical_general_templates(content["generalTemplates"] or [])
+        return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    # full definition of an existing template, the listings leave parts of it out
+    def definition(self, kind, template_id):
+        if kind == "feature":
+            return vManage(self.auth).get_feature_template_config(template_id)
+        return vManage(self.auth).get_template_config(template_id)
+
+    # id of an existing template with this name and content, None if there is none
+    def existing(self, kind, template, content_hash):
+        listed = self.templates[kind].get(template["templateName"])
+        if listed is None:
+            return None
+        if self.template_hash(kind, self.definition(kind, listed["templateId"])) == content_hash:
+            return listed["templateId"]
+        return None
+
+    def ensure(self, kind, template):
+        content_hash = self.template_hash(kind, template)
+        if (kind, content_hash) not in self.hashes:
+            self.index_candidates(kind, template)
+        template_id = self.hashes.get((kind, content_hash)) or self.existing(kind, template, content_hash)
+        if template_id is None and template["templateName"] in self.templates[kind]:
+            # the name is taken by a different template, so the content hash makes the name unique
+            template = dict(template, templateName=f"{template['templateName']}-{content_hash[:8]}")
+            template_id = self.existing(kind, template, content_hash)
+        if template_id is not None:
+            template_name = next((name for name, listed in self.templates[kind].items() if listed["templateId"] == template_id), template["templateName"])
+            print(f"Reusing {kind} template {template_name} ({template_id})")
+        elif kind == "feature":
+            template_id = vManage(self.auth).add_feature_template(template)
+        else:
+            template_id = vManage(self.auth).add_device_template(template)
+        self.hashes[(kind, content_hash)] = template_id
+        self.templates[kind].setdefault(template["templateName"], dict(template, templateId=template_id))
+        return template_id
+
+    def ensure_feature_template(self, template):
+        return self.ensure("feature", template)
+
+    def ensure_device_template(self, template):
+        return self.ensure("device", template)
+
+# general templates of a device template in a canonical order, keeping only the template references
+def canonical_general_templates(general_templates):
+    return sorted(({
+        "templateId": template.get("templateId"),
+        "templateType": template.get("templateType"),
+        "subTemplates": canonical_general_templates(template.get("subTemplates", []))
+    } for template in general_templates), key=lambda template: (template["templateType"] or "", template["templateId"] or ""))
+
+# split a comma separated list of chassis numbers or hostnames
+def split_comma_list(value):
+    return [chassis_number.strip() for chassis_number in str(value).split(",") if chassis_number.strip()]
+
+# raised when mapping entries cannot be found in the vManage inventory
+class InventoryLookupError(LookupError):
+    def __init__(self, missing):
+        self.missing = missing
+        details = "; ".join(f"{kind}: {', '.join(keys)}" for kind, keys in missing.items())
+        super().__init__(f"Not found in vManage inventory - {details}")
+
+# group template inputs by template, keeping each router once per template, e.g. when the same
+# template sheet is read for several mapping rows
+def unique_template_inputs(template_inputs):
+    grouped_inputs = {}
+    for template_id, template_input_variables in template_inputs:
+        devices = grouped_inputs.setdefault(template_id, {})
+        for device in template_input_variables:
+            devices.setdefault(device.get("csv-deviceId", len(devices)), device)
+    return [(template_id, list(devices.values())) for template_id, devices in grouped_inputs.items()]
+
+# split template inputs grouped by template into attach request chunks,
+# bounded by number of devices and serialized payload size
+def chunk_device_template_list(grouped_inputs, max_devices, max_bytes):
+    chunks = []
+    chunk = {}
+    chunk_devices = 0
+    chunk_bytes = 0
+    for template_id, template_input_variables in grouped_inputs.items():
+        for device in template_input_variables:
+            device_bytes = len(encode_json(device))
+            if chunk_devices and (chunk_devices + 1 > max_devices or chunk_bytes + device_bytes > max_bytes):
+                chunks.append(chunk)
+                chunk = {}
+                chunk_devices = 0
+                chunk_bytes = 0
+            chunk.setdefault(template_id, []).append(device)
+            chunk_devices += 1
+            chunk_bytes += device_bytes
+    if chunk_devices:
+        chunks.append(chunk)
+    return [[{
+        "templateId": template_id,
+        "device": devices,
+        "isEdited": False,
+        "isMasterEdited": False
+    } for template_id, devices in chunk.items()] for chunk in chunks]
+
+# define a class for indexed device and template inventory, built once per run
+class Inventory():
+    def __init__(self, device_list=None, device_templates=None):
+        self.device_list = device_list or []
+        self.device_templates = device_templates or []
+        self.indexes = {
+            "chassis number": self.build_index(self.device_list, "chasisNumber"),
+            "device uuid": self.build_index(self.device_list, "uuid"),
+            "hostname": self.build_index(self.device_list, "host-name"),
+            "system ip": self.build_index(self.device_list, "system-ip"),
+            "template name": self.build_index(self.device_templates, "templateName"),
+            "template id": self.build_index(self.device_templates, "templateId")
+        }
+
+    # download device list and device templates once and index them
+    @classmethod
+    def load(cls, auth, devices=True, templates=True):
+        device_list = vManage(auth).get_device_list() if devices else []
+        device_templates = vManage(auth).get_device_templates() if templates else []
+        return cls(device_list, device_templates)
+
+    # hash index of records by key, first record wins like the former next() scans
+    @staticmethod
+    def build_index(records, key):
+        index = {}
+        for record in records:
+            if key in record:
+                index.setdefault(record[key], record)
+        return index
+
+    # check all keys in one pass and report every missing one together
+    def require(self, chassis_numbers=(), uuids=(), hostnames=(), system_ips=(), template_names=(), template_ids=()):
+        requested = {
+            "chassis number": chassis_numbers,
+            "device uuid": uuids,
+            "hostname": hostnames,
+            "system ip": system_ips,
+            "template name": template_names,
+            "template id": template_ids
+        }
+        missing = {}
+        for kind, keys in requested.items():
+            index = self.indexes[kind]
+            not_found = [str(key) for key in dict.fromkeys(keys) if key not in index]
+            if not_found:
+                missing[kind] = not_found
+        if missing:
+            raise InventoryLookupError(missing)
+
+    # look up a single record, raising InventoryLookupError if not found
+    def lookup(self, kind, key):
+        try:
+            return self.indexes[kind][key]
+        except KeyError:
+            raise InventoryLookupError({kind: [str(key)]}) from None
+
+    def device_by_chassis(self, chassis_number):
+        return self.lookup("chassis number", chassis_number)
+
+    def device_by_uuid(self, device_uuid):
+        return self.lookup("device uuid", device_uuid)
+
+    def device_by_hostname(self, hostname):
+        return self.lookup("hostname", hostname)
+
+    def device_by_system_ip(self, system_ip):
+        return self.lookup("system ip", system_ip)
+
+    def template_by_name(self, template_name):
+        return self.lookup("template name", template_name)
+
+    def template_by_id(self, template_id):
+        return self.lookup("template id", template_id)
+
+    # devices for a list of chassis numbers, in the order given
+    def devices_by_chassis(self, chassis_numbers):
+        self.require(chassis_numbers=chassis_numbers)
+        return [self.device_by_chassis(chassis_number) for chassis_number in chassis_numbers]
+
+# define a class for a timing span, recording its duration and optional response size on exit
+class Span():
+    def __init__(self, metrics, kind, label):
+        self.metrics = metrics
+        self.kind = kind
+        self.label = label
+        self.size = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.kind, self.label, time.perf_counter() - self.started, self.size)
+
+# define a class for collecting call counts, latencies and sizes of vManage requests,
+# JSON decoding, workbook I/O and mapping rows
+class Metrics():
+    kinds = ("request", "decode", "workbook", "throttle", "row")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.sizes = {}
+
+    def span(self, kind, label):
+        return Span(self, kind, label)
+
+    def record(self, kind, label, seconds, size=None):
+        with self.lock:
+            self.timings.setdefault((kind, label), []).append(seconds)
+            if size is not None:
+                self.sizes[(kind, label)] = self.sizes.get((kind, label), 0) + size
+
+    # pass byte chunks through, adding their size to a label as they are consumed
+    def count_bytes(self, kind, label, chunks):
+        for chunk in chunks:
+            with self.lock:
+                self.sizes[(kind, label)] = self.sizes.get((kind, label), 0) + len(chunk)
+            yield chunk
+
+    # count, total, p50/p95/p99 and bytes per label
+    def snapshot(self):
+        with self.lock:
+            snapshot = []
+            for (kind, label), samples in self.timings.items():
+                ordered = sorted(samples)
+                snapshot.append({
+                    "kind": kind,
+                    "label": label,
+                    "count": len(ordered),
+                    "total": sum(ordered),
+                    "p50": percentile(ordered, 50),
+                    "p95": percentile(ordered, 95),
+                    "p99": percentile(ordered, 99),
+                    "bytes": self.sizes.get((kind, label), 0)
+                })
+            return snapshot
+
+    def summary(self, slowest_rows=5):
+        snapshot = self.snapshot()
+        lines = ["", "Run metrics:"]
+        for kind in self.kinds[:-1]:
+            for entry in sorted((entry for entry in snapshot if entry["kind"] == kind), key=lambda entry: -entry["total"]):
+                size = f", {entry['bytes'] / 1e3:.1f}kB" if entry["bytes"] else ""
+                lines.append(f"  {kind} {entry['label']}: {entry['count']} call(s), {entry['total']:.2f}s total, p50 {entry['p50']:.3f}s, p95 {entry['p95']:.3f}s, p99 {entry['p99']:.3f}s{size}")
+        rows = sorted((entry for entry in snapshot if entry["kind"] == "row"), key=lambda entry: -entry["total"])[:slowest_rows]
+        if rows:
+            lines.append("  slowest mapping rows: " + ", ".join(f"{entry['label']} {entry['total']:.2f}s" for entry in rows))
+        return "\n".join(lines)
+
+    # write the metrics as JSON for a .json path, otherwise as OpenMetrics text
+    def export(self, path):
+        snapshot = self.snapshot()
+        with open(path, "w") as file:
+            if path.endswith(".json"):
+                json.dump(snapshot, file, indent=2)
+                return
+            for kind in self.kinds:
+                name = f"lifecycle_{kind}_seconds"
+                file.write(f"# TYPE {name} summary\n")
+                for entry in (entry for entry in snapshot if entry["kind"] == kind):
+                    label = entry["label"].replace("\\", "\\\\").replace('"', '\\"')
+                    for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                        file.write(f'{name}{{label="{label}",quantile="{quantile}"}} {entry[key]}\n')
+                    file.write(f'{name}_count{{label="{label}"}} {entry["count"]}\n')
+                    file.write(f'{name}_sum{{label="{label}"}} {entry["total"]}\n')
+            file.write("# TYPE lifecycle_response_bytes counter\n")
+            for entry in (entry for entry in snapshot if entry["bytes"]):
+                label = entry["label"].replace("\\", "\\\\").replace('"', '\\"')
+                file.write(f'lifecycle_response_bytes_total{{label="{label}"}} {entry["bytes"]}\n')
+            file.write("# EOF\n")
+
+# nearest-rank percentile of sorted samples
+def percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(len(ordered) * percent / 100) - 1, 0)]
+
+# group request paths by endpoint, replacing ids in the path
+def endpoint_label(path):
+    return "/".join("{id}" if any(character.isdigit() for character in segment) else segment for segment in path.split("/"))
+
+# define a class for the JSON codec of vManage requests and responses, decoding straight from bytes:
+# orjson when it is installed and the codec is auto or orjson, otherwise the standard library
+class JsonCodec():
+    def __init__(self, name="auto"):
+        if name in ("auto", "orjson"):
+            try:
+                import orjson
+                self.name = "orjson"
+                self.loads = orjson.loads
+                self.dumps = orjson.dumps
+                return
+            except ImportError:
+                if name == "orjson":
+                    raise
+        self.name = "json"
+        self.loads = json.loads
+        self.dumps = lambda data: json.dumps(data, separators=(",", ":")).encode()
+
+# decode a JSON document, timing it
+def decode_json(data):
+    with metrics.span("decode", "json"):
+        return codec.loads(data)
+
+# encode a request payload as JSON bytes
+def encode_json(data):
+    return codec.dumps(data)
+
+# call a function for one mapping row, e.g. its vManage reads on the concurrent_map pool, timing it as that row
+def time_row(label, function, *args):
+    with metrics.span("row", label):
+        return function(*args)
+
+# shared metrics of the current workflow run
+metrics = Metrics()
+
+# JSON codec shared by every vManage session
+codec = JsonCodec(json_codec_name)
+
+# define a class for a persistent LRU cache of vManage GET responses, capped at max_entries per endpoint
+class ResponseCache():
+    # seconds between commits, writes in between are committed together
+    commit_interval = 1.0
+
+    def __init__(self, path, max_entries, ttls):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, endpoint TEXT, body BLOB, stored_at REAL, accessed_at REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_by_access ON entries (accessed_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_by_endpoint ON entries (endpoint, accessed_at)")
+        # entries are kept under the endpoint with ids replaced, e.g. template/feature/object/{id}
+        for (endpoint,) in self.db.execute("SELECT DISTINCT endpoint FROM entries").fetchall():
+            if endpoint_label(endpoint) != endpoint:
+                self.db.execute("UPDATE entries SET endpoint = ? WHERE endpoint = ?", (endpoint_label(endpoint), endpoint))
+        self.counts = dict(self.db.execute("SELECT endpoint, COUNT(*) FROM entries GROUP BY endpoint").fetchall())
+        self.db.commit()
+        self.committed_at = time.time()
+
+    # TTL of the most specific endpoint prefix, 0 means not cached
+    def ttl(self, endpoint):
+        matches = [prefix for prefix in self.ttls if endpoint.startswith(prefix)]
+        return self.ttls[max(matches, key=len)] if matches else 0
+
+    # return cached body if still fresh, otherwise None
+    def get(self, key, endpoint):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT body, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl(endpoint):
+                self.delete_keys([key])
+                self.commit_due()
+                return None
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self.commit_due()
+            return row[0]
+
+    # store a response body with the tags that invalidate it, evicting the least recently used
+    # entries of the same endpoint, so many per-router reads do not push out the inventory and templates
+    def put(self, key, endpoint, body, tags):
+        if self.ttl(endpoint) <= 0:
+            return
+        now = time.time()
+        endpoint = endpoint_label(endpoint)
+        with self.lock:
+            self.delete_keys([key])
+            self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", (key, endpoint, body, now, now))
+            self.db.executemany("INSERT INTO tags VALUES (?, ?)", [(tag, key) for tag in set(tags)])
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            overflow = self.counts[endpoint] - self.max_entries
+            if overflow > 0:
+                stale = self.db.execute("SELECT key FROM entries WHERE endpoint = ? ORDER BY accessed_at LIMIT ?", (endpoint, overflow)).fetchall()
+                self.delete_keys([row[0] for row in stale])
+            self.commit_due()
+
+    # drop every entry carrying any of the given tags
+    def invalidate(self, tags):
+        with self.lock:
+            keys = set()
+            for tag in set(tags):
+                keys.update(row[0] for row in self.db.execute("SELECT key FROM tags WHERE tag = ?", (tag,)))
+            self.delete_keys(keys)
+            self.commit_due()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("DELETE FROM tags")
+            self.counts = {}
+            self.db.commit()
+
+    def delete_keys(self, keys):
+        for key in keys:
+            row = self.db.execute("SELECT endpoint FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.counts[row[0]] -= 1
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.execute("DELETE FROM tags WHERE key = ?", (key,))
+
+    # commit once commit_interval has passed since the last commit, called with the lock held
+    def commit_due(self):
+        if time.time() - self.committed_at >= self.commit_interval:
+            self.db.commit()
+            self.committed_at = time.time()
+
+    # commit the writes since the last commit
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.committed_at = time.time()
+
+# get the shared response cache, None when caching is disabled
+def get_response_cache():
+    global response_cache
+    if response_cache is None and vmanage_cache_file:
+        response_cache = ResponseCache(vmanage_cache_file, vmanage_cache_max_entries, cache_ttls)
+    return response_cache
+
+# commit the cached reads of a workflow run
+def flush_response_cache():
+    if response_cache is not None:
+        response_cache.flush()
+
+# define a class for tracking many vManage actions (attach, detach, sync, decommission) on one polling schedule
+class ActionTracker():
+    def __init__(self, auth, poll_interval=None, max_poll_interval=30, backoff=1.5, timeout=None):
+        self.auth = auth
+        self.poll_interval = vmanage_action_poll_interval if poll_interval is None else poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.timeout = vmanage_action_timeout if timeout is None else timeout
+        self.interval = self.poll_interval
+        self.actions = {}
+
+    # start tracking an action, callbacks are called with (action_id, summary) when it finishes
+    def add(self, action_id, kind, timeout=None, on_success=None, on_failure=None):
+        self.actions[action_id] = {
+            "kind": kind,
+            "state": "pending",
+            "summary": None,
+            "deadline": time.time() + (self.timeout if timeout is None else timeout),
+            "on_success": on_success,
+            "on_failure": on_failure
+        }
+
+    def pending(self, action_ids=None):
+        action_ids = self.actions if action_ids is None else action_ids
+        return [action_id for action_id in action_ids if self.actions[action_id]["state"] == "pending"]
+
+    # poll every pending action once, returns the ids that finished in this round
+    def poll(self):
+        pending = self.pending()
+        if not pending:
+            return []
+        vmanage = vManage(self.auth)
+        summaries = vmanage.concurrent_map(vmanage.get_action_summary, [(action_id,) for action_id in pending])
+        finished = []
+        now = time.time()
+        for action_id, summary in zip(pending, summaries):
+            action = self.actions[action_id]
+            action["summary"] = summary
+            if summary["status"] == "done":
+                failures = summary.get("count", {}).get("Failure", 0)
+                action["state"] = "failure" if failures else "success"
+            elif now > action["deadline"]:
+                action["state"] = "timeout"
+            else:
+                continue
+            finished.append(action_id)
+            callback = action["on_success"] if action["state"] == "success" else action["on_failure"]
+            if callback is not None:
+                callback(action_id, summary)
+        return finished
+
+    # block until count of the given actions (all by default) have finished, polling with adaptive backoff
+    def wait(self, action_ids=None, count=None):
+        action_ids = list(self.actions if action_ids is None else action_ids)
+        count = len(action_ids) if count is None else min(count, len(action_ids))
+        while len(action_ids) - len(self.pending(action_ids)) < count:
+            time.sleep(self.interval)
+            if self.poll():
+                self.interval = self.poll_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_poll_interval)
+        return {action_id: self.actions[action_id] for action_id in action_ids}
+
+    def wait_one(self, action_id):
+        return self.wait([action_id])[action_id]
+
+    def wait_all(self, action_ids=None):
+        return self.wait(action_ids)
+
+    def wait_first(self, count, action_ids=None):
+        return self.wait(action_ids, count)
+
+# define a class for rolling out template attachments in a canary group followed by growing waves
+class RolloutScheduler():
+    def __init__(self, auth, canary_size=None, growth_factor=None, max_in_flight=None, max_failure_rate=None):
+        self.auth = auth
+        self.canary_size = rollout_canary_size if canary_size is None else canary_size
+        self.growth_factor = rollout_growth_factor if growth_factor is None else growth_factor
+        self.max_in_flight = rollout_max_in_flight if max_in_flight is None else max_in_flight
+        self.max_failure_rate = rollout_max_failure_rate if max_failure_rate is None else max_failure_rate
+
+    # split devices into a canary wave and geometrically growing waves capped at max_in_flight
+    def plan(self, devices):
+        waves = []
+        size = max(min(self.canary_size, self.max_in_flight), 1)
+        start = 0
+        while start < len(devices):
+            waves.append(devices[start:start + size])
+            start += size
+            size = min(max(math.ceil(size * self.growth_factor), size + 1), self.max_in_flight)
+        return waves
+
+    # seconds the remaining waves should take: the observed duration of a wave of the same size, otherwise
+    # a line fitted through the observed durations by wave size, proportional to size until two sizes are seen
+    def estimate(self, wave_seconds, remaining_waves):
+        sizes = list(wave_seconds)
+        mean_size = sum(sizes) / len(sizes)
+        mean_seconds = sum(wave_seconds.values()) / len(sizes)
+        variance = sum((size - mean_size) ** 2 for size in sizes)
+        if variance:
+            slope = max(sum((size - mean_size) * (wave_seconds[size] - mean_seconds) for size in sizes) / variance, 0)
+        else:
+            slope = mean_seconds / mean_size
+        intercept = max(mean_seconds - slope * mean_size, 0)
+        return sum(wave_seconds.get(len(wave), intercept + slope * len(wave)) for wave in remaining_waves)
+
+    # attach device inputs to the template wave by wave, aborting once the failure rate exceeds the threshold,
+    # recording each wave in the run journal when one is given
+    def run(self, template_id, template_inputs, journal=None):
+        waves = self.plan(template_inputs)
+        tracker = ActionTracker(self.auth)
+        started = time.time()
+        deployed = 0
+        failed = 0
+        action_devices = {}
+        succeeded_devices = set()
+        wave_seconds = {}
+        def attach_started(action_id, device_template_list):
+            action_devices[action_id] = {device["csv-deviceId"] for device_template in device_template_list for device in device_template["device"]}
+            if journal:
+                journal.attach_started(action_id, device_template_list)
+        for wave_number, wave in enumerate(waves, start=1):
+            label = "canary" if wave_number == 1 else f"wave {wave_number - 1}"
+            wave_started = time.time()
+            action_ids = vManage(self.auth).attach_templates([(template_id, wave)], on_action=attach_started)
+            for action_id in action_ids:
+                if journal:
+                    journal.track(tracker, action_id, "attach")
+                else:
+                    tracker.add(action_id, "attach")
+            results = tracker.wait_all(action_ids)
+            for action_id, action in results.items():
+                if action["state"] == "success":
+                    succeeded_devices |= action_devices[action_id]
+            succeeded = sum(action["summary"].get("count", {}).get("Success", 0) for action in results.values() if action["summary"])
+            deployed += len(wave)
+            failed += max(len(wave) - succeeded, 0)
+            wave_seconds[len(wave)] = time.time() - wave_started
+            elapsed = time.time() - started
+            eta = self.estimate(wave_seconds, waves[wave_number:])
+            print(f"Rollout {label}: {len(wave)} device(s), {deployed}/{len(template_inputs)} deployed, {failed} failed, elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+            if failed / deployed > self.max_failure_rate:
+                print(f"Rollout aborted after {label}: failure rate {failed / deployed:.0%} exceeds {self.max_failure_rate:.0%}")
+                break
+        return {"deployed": deployed, "failed": failed, "total": len(template_inputs), "aborted": deployed < len(template_inputs), "succeeded": succeeded_devices}
+
+# define a class for the run journal, an append-only JSON lines log of the finished steps and started actions
+# of a workflow run, keyed by workflow, mapping file hash and row, that a resumed run reads back
+class RunJournal():
+    # journals of parallel batch jobs share the journal file
+    append_lock = threading.Lock()
+
+    def __init__(self, workflow, source, path=None):
+        self.key = f"{workflow}:{source}"
+        self.path = vmanage_journal_file if path is None else path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.actions = {}
+        if self.path and resume_run and os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by the interruption
+                        continue
+                    if entry.get("key") != self.key:
+                        continue
+                    if entry["step"] == "run":
+                        if not entry["resume"]:
+                            self.entries.clear()
+                            self.actions.clear()
+                    elif entry["step"] == "action":
+                        self.actions[entry["row"]] = entry["state"]
+                    else:
+                        self.entries[(entry["step"], entry["row"])] = entry
+            print(f"Resuming {workflow} with {len(self.entries)} step(s) recorded by the interrupted run")
+        self.append([{"step": "run", "row": None, "resume": resume_run}])
+
+    def append(self, entries):
+        if not self.path:
+            return
+        with RunJournal.append_lock, open(self.path, "a") as file:
+            for entry in entries:
+                file.write(json.dumps(dict(entry, key=self.key, time=time.time())) + "\n")
+
+    # record a finished step of a row, or a step that started an action
+    def record(self, step, row=None, action_id=None, **result):
+        entry = dict(result, step=step, row=row, actionId=action_id)
+        with self.lock:
+            self.entries[(step, row)] = entry
+        self.append([entry])
+
+    def entry(self, step, row=None):
+        return self.entries.get((step, row))
+
+    # a step is done when it was recorded and the action it started, if any, succeeded
+    def done(self, step, row=None):
+        entry = self.entry(step, row)
+        return entry is not None and (entry["actionId"] is None or self.actions.get(entry["actionId"]) == "success")
+
+    # ActionTracker callback recording the outcome of an action that finished
+    def action_done(self, action_id, summary):
+        if summary is None or summary["status"] != "done":
+            return
+        state = "failure" if summary.get("count", {}).get("Failure", 0) else "success"
+        with self.lock:
+            self.actions[action_id] = state
+        self.append([{"step": "action", "row": action_id, "state": state}])
+
+    def track(self, tracker, action_id, kind):
+        tracker.add(action_id, kind, on_success=self.action_done, on_failure=self.action_done)
+
+    # run a step that starts one action and wait for it: an action started by the interrupted run is
+    # waited for instead of started again, a failed one is started again; returns the action state
+    def run_action(self, tracker, step, kind, start, row=None):
+        entry = self.entry(step, row)
+        action_id = entry["actionId"] if entry else None
+        state = self.actions.get(action_id)
+        if state == "success":
+            return state
+        if action_id is None or state is not None:
+            action_id = start()
+            self.record(step, row, action_id=action_id)
+        self.track(tracker, action_id, kind)
+        return tracker.wait_one(action_id)["state"]
+
+    # attachfeature on_action callback recording the attach action of every router in the request
+    def attach_started(self, action_id, device_template_list):
+        entries = [{
+            "step": "attach",
+            "row": values.get("csv-deviceId"),
+            "actionId": action_id
+        } for device_template in device_template_list for values in device_template["device"]]
+        with self.lock:
+            for entry in entries:
+                self.entries[("attach", entry["row"])] = entry
+        self.append(entries)
+
+    # template inputs of the routers still to attach, after waiting for the attach actions the
+    # interrupted run left in flight; routers attached successfully are left out
+    def pending_attach(self, tracker, template_inputs):
+        in_flight = sorted({
+            self.entry("attach", values.get("csv-deviceId"))["actionId"]
+            for template_id, rows in template_inputs for values in rows
+            if self.entry("attach", values.get("csv-deviceId")) and self.entry("attach", values.get("csv-deviceId"))["actionId"] not in self.actions
+        })
+        for action_id in in_flight:
+            self.track(tracker, action_id, "attach")
+        tracker.wait_all(in_flight)
+        pending = []
+        for template_id, rows in template_inputs:
+            rows = [values for values in rows if not self.done("attach", values.get("csv-deviceId"))]
+            if rows:
+                pending.append((template_id, rows))
+        return pending
+
+# hash of the contents of a mapping file, or of every file in a mapping directory
+def mapping_hash(file):
+    digest = hashlib.sha256()
+    paths = [file] if os.path.isfile(file) else sorted(os.path.join(file, name) for name in os.listdir(file))
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as mapping_file:
+            for chunk in iter(lambda: mapping_file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# define a class for a compact device record holding only the device fields used by the workflows,
+# read with the same keys as the vManage device dicts
+class DeviceRecord():
+    fields = ("chasisNumber", "uuid", "host-name", "deviceIP", "system-ip", "serialNumber", "templateId", "deviceType")
+    __slots__ = ("chasis_number", "uuid", "host_name", "device_ip", "system_ip", "serial_number", "template_id", "device_type")
+    slot_of = dict(zip(fields, __slots__))
+
+    # slots are set one by one, a record is built per device of the inventory
+    def __init__(self, chasis_number=None, uuid=None, host_name=None, device_ip=None, system_ip=None, serial_number=None, template_id=None, device_type=None):
+        self.chasis_number = chasis_number
+        self.uuid = uuid
+        self.host_name = host_name
+        self.device_ip = device_ip
+        self.system_ip = system_ip
+        self.serial_number = serial_number
+        self.template_id = template_id
+        self.device_type = device_type
+
+    @classmethod
+    def from_dict(cls, device):
+        get = device.get
+        return cls(get("chasisNumber"), get("uuid"), get("host-name"), get("deviceIP"), get("system-ip"), get("serialNumber"), get("templateId"), get("deviceType"))
+
+    def values(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def __getitem__(self, field):
+        value = getattr(self, self.slot_of[field]) if field in self.slot_of else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    # fields missing from the vManage device dict are not in the record either
+    def __contains__(self, field):
+        return field in self.slot_of and getattr(self, self.slot_of[field]) is not None
+
+    def get(self, field, default=None):
+        return self[field] if field in self else default
+
+    def __repr__(self):
+        return f"DeviceRecord({', '.join(f'{field}={self.get(field)!r}' for field in self.fields if field in self)})"
+
+# define a class for reading JSON values one at a time from a stream of byte chunks, finding where each
+# value ends in the bytes and decoding it with the shared codec; values end on ASCII characters,
+# so a multibyte UTF-8 character split across chunks is decoded whole
+class JsonStreamReader():
+    whitespace = re.compile(rb"[ \t\r\n]*")
+    # a complete string, or the characters of a container up to its next bracket or incomplete string
+    string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+    container = re.compile(rb'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+    scalar = re.compile(rb"[^,:\]} \t\r\n]*")
+    separator = re.compile(rb"[ \t\r\n]*,?[ \t\r\n]*")
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.position = 0
+
+    # append the next chunk to the unread part of the buffer, False at end of stream
+    def read_more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    # next non-whitespace character, without consuming it
+    def peek(self):
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return chr(self.buffer[self.position])
+            if not self.read_more():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError(f"Expected {character!r} in JSON stream, found {self.buffer[self.position:self.position + 20]!r}")
+        self.position += 1
+
+    # consume the comma after a value, returning the next non-whitespace character
+    def next_item(self):
+        end = self.separator.match(self.buffer, self.position).end()
+        if end < len(self.buffer):
+            self.position = end
+            return chr(self.buffer[end])
+        if self.peek() == ",":
+            self.position += 1
+        return self.peek()
+
+    # end of the value starting at the current position, reading more chunks until it is complete;
+    # offsets are kept relative to the position, which a read moves to the start of the buffer
+    def value_end(self):
+        first = self.peek()
+        if first in "{[":
+            # a flat object or array, e.g. a device dict, ends at its first closing bracket
+            # when no string is open before it
+            end = self.buffer.find(b"}" if first == "{" else b"]", self.position)
+            if end != -1 and self.buffer.count(b'"', self.position, end) % 2 == 0 and all(self.buffer.find(character, self.position + 1, end) == -1 for character in (b"{", b"[", b"\\")):
+                return end + 1
+            depth = 0
+            offset = 0
+            while True:
+                end = self.container.match(self.buffer, self.position + offset).end()
+                if end < len(self.buffer) and self.buffer[end] != ord('"'):
+                    depth += 1 if self.buffer[end] in b"{[" else -1
+                    offset = end + 1 - self.position
+                    if depth == 0:
+                        return end + 1
+                    continue
+                # the container goes on, or a string in it does, in the next chunk
+                offset = end - self.position
+                if not self.read_more():
+                    raise ValueError("Unexpected end of JSON stream")
+        while True:
+            if first == '"':
+                match = self.string.match(self.buffer, self.position)
+                if match:
+                    return match.end()
+            else:
+                # a number at the end of the buffer may continue in the next chunk
+                end = self.scalar.match(self.buffer, self.position).end()
+                if end < len(self.buffer):
+                    return end
+            if not self.read_more():
+                if first != '"':
+                    return self.scalar.match(self.buffer, self.position).end()
+                raise ValueError("Unexpected end of JSON stream")
+
+    # decode the next complete JSON value
+    def decode(self):
+        end = self.value_end()
+        value = codec.loads(self.buffer[self.position:end])
+        self.position = end
+        return value
+
+    # decode the values of the array at the current position; objects and arrays are decoded together up to
+    # the last one complete in the buffer, a failed attempt (its last closing bracket was inside a value)
+    # decodes the rest of the array one value at a time
+    def items(self):
+        self.expect("[")
+        together = True
+        character = self.peek()
+        while character != "]":
+            if together and character in "{[":
+                end = self.buffer.rfind(b"}" if character == "{" else b"]", self.position)
+                if end != -1:
+                    try:
+                        values = codec.loads(b"[" + self.buffer[self.position:end + 1] + b"]")
+                    except ValueError:
+                        together = False
+                    else:
+                        self.position = end + 1
+                        yield from values
+                        character = self.next_item()
+                        continue
+            yield self.decode()
+            character = self.next_item()
+
+# stream the items of the array under a top-level key (response["data"]) from response byte chunks
+def iter_json_array(chunks, key="data"):
+    reader = JsonStreamReader(chunks)
+    reader.expect("{")
+    character = reader.peek()
+    while character != "}":
+        name = reader.decode()
+        reader.expect(":")
+        if name == key:
+            yield from reader.items()
+            return
+        reader.decode()
+        character = reader.next_item()
+
+# serializes re-login of sessions shared by concurrent calls
+login_lock = threading.Lock()
+
+# a 401/403 or the HTML login page returned in place of API data means the session expired
+def is_session_expired(response):
+    if response.status_code in (401, 403):
+        return True
+    content_type = response.headers.get("Content-Type", "")
+    return content_type.startswith("text/html") and b"j_security_check" in response.content
+
+# full-jitter exponential backoff, honouring a numeric Retry-After header
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None and str(retry_after).isdigit():
+        return min(float(retry_after), vmanage_retry_backoff_max)
+    return random.uniform(0, min(vmanage_retry_backoff_max, vmanage_retry_backoff * 2 ** attempt))
+
+# define a class for a token bucket allowing rate requests per second in bursts of up to one second,
+# a rate of 0 means unlimited
+class TokenBucket():
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # take a token, sleeping until it is available, returns the seconds waited
+    def acquire(self):
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+# define a class for an AIMD limit on requests in flight: the limit grows by one for every limit
+# requests answered within the latency target, and halves at most once per latency target
+# when vManage throttles, is unavailable, times out or answers slower than the target
+class ConcurrencyLimit():
+    def __init__(self, initial, maximum, latency_target, minimum=1, decrease=0.5):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    # wait for a free slot, returns the seconds waited
+    def acquire(self):
+        started = time.monotonic()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic() - started
+
+    def release(self, latency, overloaded):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                if now - self.last_decrease >= self.latency_target:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+# define a class for pacing every vManage request: a token bucket per request class (read, write and push),
+# an AIMD limit on requests in flight, and a cap on outstanding device push jobs
+class Governor():
+    def __init__(self):
+        self.buckets = {
+            "read": TokenBucket(vmanage_rate_read),
+            "write": TokenBucket(vmanage_rate_write),
+            "push": TokenBucket(vmanage_rate_push)
+        }
+        self.concurrency = ConcurrencyLimit(vmanage_concurrency, vmanage_pool_size, vmanage_latency_target)
+        self.max_push_jobs = vmanage_max_push_jobs
+        self.push_jobs = {}
+        self.push_reserved = 0
+        self.push_polling = False
+        self.condition = threading.Condition()
+
+    # reads are GETs and POSTs marked idempotent, pushes start a job on devices or controllers
+    def classify(self, method, path, idempotent=None):
+        if method == "POST" and path.startswith(push_endpoints):
+            return "push"
+        if method == "GET" or (method == "POST" and idempotent):
+            return "read"
+        return "write"
+
+    # wait for a token of the request class and a slot in flight
+    def acquire(self, request_class):
+        wait = self.buckets[request_class].acquire() + self.concurrency.acquire()
+        if wait > 0.001:
+            metrics.record("throttle", request_class, wait)
+
+    def release(self, latency, overloaded):
+        self.concurrency.release(latency, overloaded)
+
+    # reserve one of the outstanding push jobs, polling the oldest jobs while all are taken
+    def reserve_push(self, vmanage):
+        started = time.monotonic()
+        while True:
+            with self.condition:
+                self.expire_push_jobs()
+                if len(self.push_jobs) + self.push_reserved < self.max_push_jobs or self.max_push_jobs <= 0:
+                    self.push_reserved += 1
+                    break
+                if self.push_polling:
+                    self.condition.wait(vmanage_action_poll_interval)
+                    continue
+                self.push_polling = True
+                action_ids = sorted(self.push_jobs, key=self.push_jobs.get)
+            try:
+                summaries = [vmanage.get_action_summary(action_id) for action_id in action_ids]
+                if not any(summary["status"] == "done" for summary in summaries):
+                    time.sleep(vmanage_action_poll_interval)
+            finally:
+                with self.condition:
+                    self.push_polling = False
+                    self.condition.notify_all()
+        wait = time.monotonic() - started
+        if wait > 0.001:
+            metrics.record("throttle", "push jobs", wait)
+
+    # turn a reservation into an outstanding job, or give it back when no job was started
+    def start_push(self, action_id):
+        with self.condition:
+            self.push_reserved -= 1
+            if action_id:
+                self.push_jobs[action_id] = time.monotonic()
+            self.condition.notify_all()
+
+    def finish_push(self, action_id):
+        with self.condition:
+            if self.push_jobs.pop(action_id, None) is not None:
+                self.condition.notify_all()
+
+    # forget jobs nobody saw finish within the action timeout
+    def expire_push_jobs(self):
+        deadline = time.monotonic() - vmanage_action_timeout
+        for action_id, started in list(self.push_jobs.items()):
+            if started < deadline:
+                del self.push_jobs[action_id]
+
+# shared by every vManage session of the process
+governor = Governor()
+
 # define a class for vManage object
 class vManage():
     def __init__(self, session):
-        self.base_url = f"https://{vmanage_host}:{vmanage_port}"
+        self.base_url = f"{vmanage_scheme}://{vmanage_host}:{vmanage_port}"
         self.username = vmanage_username
         self.password = vmanage_password
         if session == None:
             self.session = requests.Session()
+            # size the connection pool so concurrent calls share keep-alive connections
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=vmanage_pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            if not vmanage_keep_alive:
+                self.session.headers["Connection"] = "close"
         else:
             self.session = session
 
@@ -330,40 +2021,160 @@ class vManage():
             "j_username": self.username,
             "j_password": self.password
         }
-        jsession = self.session.post(f"{self.base_url}/j_security_check", headers=headers, data=payload, verify=False)
+        governor.acquire("write")
+        started = time.monotonic()
+        try:
+            jsession = self.session.post(f"{self.base_url}/j_security_check", headers=headers, data=payload, verify=False)
 
-        # vManage authentication - get X-XSRF-TOKEN
-        token = self.session.get(f"{self.base_url}/dataservice/client/token")
+            # vManage authentication - get X-XSRF-TOKEN
+            token = self.session.get(f"{self.base_url}/dataservice/client/token", verify=False)
+        finally:
+            governor.release(time.monotonic() - started, False)
         self.session.headers["X-XSRF-TOKEN"] = token.text
+        self.session.login_generation = getattr(self.session, "login_generation", 0) + 1
 
         return self.session
 
+    # log in again after the session expired, once for all threads sharing the session
+    def reauthenticate(self, login_generation):
+        with login_lock:
+            if getattr(self.session, "login_generation", 0) == login_generation:
+                self.session.cookies.clear()
+                self.session.headers.pop("X-XSRF-TOKEN", None)
+                self.authentication()
+
+    # send a request to a dataservice endpoint through the governor, counting a started push job
+    # as outstanding until its action is seen finished
+    def request(self, method, path, idempotent=None, **kwargs):
+        request_class = governor.classify(method, path, idempotent)
+        if request_class != "push":
+            return self.send(method, path, request_class, idempotent, **kwargs)
+        governor.reserve_push(self)
+        action_id = None
+        try:
+            response = self.send(method, path, request_class, idempotent, **kwargs)
+            if response.ok:
+                action_id = codec.loads(response.content).get("id")
+            return response
+        finally:
+            governor.start_push(action_id)
+
+    # send a request, logging in again when the session expired and retrying with jittered backoff
+    # on throttling and, for idempotent requests, on dropped connections
+    def send(self, method, path, request_class, idempotent=None, **kwargs):
+        idempotent = method in ("GET", "PUT", "DELETE") if idempotent is None else idempotent
+        relogged = False
+        attempt = 0
+        while True:
+            login_generation = getattr(self.session, "login_generation", 0)
+            governor.acquire(request_class)
+            started = time.monotonic()
+            try:
+                with metrics.span("request", f"{method} {endpoint_label(path)}") as span:
+                    response = self.session.request(method, f"{self.base_url}/dataservice/{path}", verify=False, **kwargs)
+                    if not kwargs.get("stream"):
+                        span.size = len(response.content)
+            except BaseException as error:
+                governor.release(time.monotonic() - started, True)
+                if not isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                    raise
+                # a request that never connected was not processed and is always safe to send again
+                if attempt >= vmanage_max_retries or not (idempotent or isinstance(error, requests.exceptions.ConnectTimeout)):
+                    raise
+                attempt += 1
+                time.sleep(retry_delay(attempt))
+                continue
+            governor.release(time.monotonic() - started, response.status_code in (429, 503))
+            if is_session_expired(response) and not relogged:
+                relogged = True
+                self.reauthenticate(login_generation)
+                continue
+            retryable = response.status_code in (429, 503) or (idempotent and response.status_code in (502, 504))
+            if retryable and attempt < vmanage_max_retries:
+                attempt += 1
+                time.sleep(retry_delay(attempt, response.headers.get("Retry-After")))
+                continue
+            return response
+
+    # call a vManage method for each argument tuple on a bounded thread pool sharing this session
+    # results are returned in input order
+    def concurrent_map(self, method, args_list, concurrency=None):
+        args_list = list(args_list)
+        concurrency = vmanage_concurrency if concurrency is None else concurrency
+        if concurrency <= 1 or len(args_list) <= 1:
+            return [method(*args) for args in args_list]
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(args_list))) as executor:
+            return list(executor.map(lambda args: method(*args), args_list))
+
+    # serve a read from the local cache, or fetch it and cache the raw response body,
+    # refresh fetches it again even when it is cached
+    def cached_read(self, endpoint, tags, fetch, key=None, refresh=False):
+        cache = get_response_cache()
+        cache_key = f"{self.base_url}/{endpoint}" + (f"?{key}" if key else "")
+        if cache is not None and not (cache_refresh or refresh):
+            body = cache.get(cache_key, endpoint)
+            if body is not None:
+                return decode_json(body)
+        response = fetch()
+        if cache is not None and response.ok:
+            cache.put(cache_key, endpoint, response.content, tags + [endpoint])
+        return decode_json(response.content)
+
+    # drop cached reads touched by a change
+    def invalidate_cache(self, tags):
+        cache = get_response_cache()
+        if cache is not None:
+            cache.invalidate(tags)
+
     # vManage get device templates
     def get_device_templates(self):
-        response = self.session.get(f"{self.base_url}/dataservice/template/device", verify=False)
-        response = json.loads(response.text)
+        response = self.cached_read("template/device", ["templates"], lambda: self.request("GET", "template/device"))
         return response["data"]
 
     # vManage get feature templates
     def get_feature_templates(self):
-        response = self.session.get(f"{self.base_url}/dataservice/template/feature", verify=False)
-        response = json.loads(response.text)
+        response = self.cached_read("template/feature", ["feature-templates"], lambda: self.request("GET", "template/feature"))
         return response["data"]
 
-    # vManage get device list
-    def get_device_list(self, category="vedges"):
-        response = self.session.get(f"{self.base_url}/dataservice/system/device/{category}", verify=False)
-        response = json.loads(response.text)
+    # vManage get device list, as compact DeviceRecord objects unless full device dicts are asked for
+    def get_device_list(self, category="vedges", full=False):
+        if not full:
+            return self.stream_device_list(category)
+        response = self.cached_read(f"system/device/{category}", ["devices"], lambda: self.request("GET", f"system/device/{category}"))
         return response["data"]
 
+    # vManage get device list, parsed incrementally from the response bytes into compact records
+    def stream_device_list(self, category="vedges"):
+        endpoint = f"system/device/{category}"
+        cache = get_response_cache()
+        cache_key = f"{self.base_url}/{endpoint}?compact"
+        if cache is not None and not cache_refresh:
+            body = cache.get(cache_key, endpoint)
+            if body is not None:
+                return [DeviceRecord(*values) for values in decode_json(body)]
+        response = self.request("GET", endpoint, stream=True)
+        response.raise_for_status()
+        with response:
+            chunks = metrics.count_bytes("request", f"GET {endpoint_label(endpoint)}", response.iter_content(chunk_size=65536))
+            # the response body is read as it is decoded, so the decode time includes reading it
+            with metrics.span("decode", f"GET {endpoint_label(endpoint)}"):
+                device_list = [DeviceRecord.from_dict(device) for device in iter_json_array(chunks)]
+        if cache is not None:
+            cache.put(cache_key, endpoint, encode_json([device.values() for device in device_list]), ["devices", endpoint])
+        return device_list
+
+    # vManage get feature template config
+    def get_feature_template_config(self, template_id):
+        response = self.cached_read(f"template/feature/object/{template_id}", [f"template:{template_id}"], lambda: self.request("GET", f"template/feature/object/{template_id}"))
+        return response
+
     # vManage get template config
     def get_template_config(self, template_id):
-        response = self.session.get(f"{self.base_url}/dataservice/template/device/object/{template_id}", verify=False)
-        response = json.loads(response.text)
+        response = self.cached_read(f"template/device/object/{template_id}", [f"template:{template_id}"], lambda: self.request("GET", f"template/device/object/{template_id}"))
         return response
 
-    # vManage get template input variables
-    def get_template_input(self, template_id, device_id_list):
+    # vManage get template input variables, refresh reads the values deployed now instead of cached ones
+    def get_template_input(self, template_id, device_id_list, refresh=False):
         headers = {
             "Content-Type": "application/json"
         }
@@ -373,8 +2184,8 @@ class vManage():
             "isMasterEdited": False,
             "templateId": template_id
         }
-        response = self.session.post(f"{self.base_url}/dataservice/template/device/config/input", headers=headers, data=json.dumps(payload), verify=False)
-        response = json.loads(response.text)
+        tags = [f"template:{template_id}"] + [f"device:{device_id}" for device_id in device_id_list]
+        response = self.cached_read("template/device/config/input", tags, lambda: self.request("POST", "template/device/config/input", idempotent=True, headers=headers, data=encode_json(payload)), key=json.dumps(payload, sort_keys=True), refresh=refresh)
         return response["data"]
 
     # vManage get devices attached to template
@@ -382,8 +2193,7 @@ class vManage():
         headers = {
             "Content-Type": "application/json"
         }
-        response = self.session.get(f"{self.base_url}/dataservice/template/device/config/attached/{template_id}", headers=headers, verify=False)
-        response = json.loads(response.text)
+        response = self.cached_read(f"template/device/config/attached/{template_id}", [f"template:{template_id}", "attached"], lambda: self.request("GET", f"template/device/config/attached/{template_id}", headers=headers))
         return response["data"]
 
     # vManage add feature template
@@ -391,8 +2201,9 @@ class vManage():
         headers = {
             "Content-Type": "application/json"
         }
-        response = self.session.post(f"{self.base_url}/dataservice/template/feature", headers=headers, data=json.dumps(template_config), verify=False)
-        response = json.loads(response.text)
+        response = self.request("POST", "template/feature", headers=headers, data=encode_json(template_config))
+        response = decode_json(response.content)
+        self.invalidate_cache(["feature-templates"])
         return response["templateId"]
 
     # vManage add feature template
@@ -400,8 +2211,9 @@ class vManage():
         headers = {
             "Content-Type": "application/json"
         }
-        response = self.session.post(f"{self.base_url}/dataservice/template/device/feature", headers=headers, data=json.dumps(template_config), verify=False)
-        response = json.loads(response.text)
+        response = self.request("POST", "template/device/feature", headers=headers, data=encode_json(template_config))
+        response = decode_json(response.content)
+        self.invalidate_cache(["templates"])
         return response["templateId"]
 
     # vManage attach router to template
@@ -417,10 +2229,41 @@ class vManage():
                 "isMasterEdited": False
             }]
         }
-        response = self.session.post(f"{self.base_url}/dataservice/template/device/config/attachfeature", headers=headers, data=json.dumps(payload), verify=False)
-        response = json.loads(response.text)
+        response = self.request("POST", "template/device/config/attachfeature", headers=headers, data=encode_json(payload))
+        response = decode_json(response.content)
+        self.invalidate_attached(payload["deviceTemplateList"])
         return response
 
+    # vManage attach routers to many templates, grouped by template and split into chunked requests
+    # template_inputs is a list of (template_id, template_input_variables), returns one action ID per chunk
+    def attach_templates(self, template_inputs, max_devices=None, max_bytes=None, on_action=None):
+        headers = {
+            "Content-Type": "application/json"
+        }
+        grouped_inputs = dict(unique_template_inputs(template_inputs))
+        max_devices = vmanage_attach_chunk_devices if max_devices is None else max_devices
+        max_bytes = vmanage_attach_chunk_bytes if max_bytes is None else max_bytes
+        action_ids = []
+        for device_template_list in chunk_device_template_list(grouped_inputs, max_devices, max_bytes):
+            payload = {
+                "deviceTemplateList": device_template_list
+            }
+            response = self.request("POST", "template/device/config/attachfeature", headers=headers, data=encode_json(payload))
+            response = decode_json(response.content)
+            self.invalidate_attached(device_template_list)
+            action_ids.append(response["id"])
+            if on_action is not None:
+                on_action(response["id"], device_template_list)
+        return action_ids
+
+    # drop cached reads for templates and routers in an attach request
+    def invalidate_attached(self, device_template_list):
+        tags = ["templates", "devices", "attached"]
+        for device_template in device_template_list:
+            tags.append(f"template:{device_template['templateId']}")
+            tags += [f"device:{device['csv-deviceId']}" for device in device_template["device"] if "csv-deviceId" in device]
+        self.invalidate_cache(tags)
+
     # vManage detach router from template
     def detach_template(self, device_type, device_uuid, device_ip):
         headers = {
@@ -433,12 +2276,40 @@ class vManage():
                 "deviceIP": device_ip,
             }]
         }
-        response = self.session.post(f"{self.base_url}/dataservice/template/config/device/mode/cli", headers=headers, data=json.dumps(payload), verify=False)
-        response = json.loads(response.text)
+        response = self.request("POST", "template/config/device/mode/cli", headers=headers, data=encode_json(payload))
+        response = decode_json(response.content)
+        self.invalidate_cache([f"device:{device_uuid}", "templates", "devices", "attached"])
         return response
 
+    # vManage detach routers from templates, one request per device type
+    def detach_templates(self, devices):
+        headers = {
+            "Content-Type": "application/json"
+        }
+        devices_by_type = {}
+        for device in devices:
+            devices_by_type.setdefault(device["deviceType"], []).append(device)
+        responses = []
+        for device_type, typed_devices in devices_by_type.items():
+            payload = {
+                "deviceType": device_type,
+                "devices": [{
+                    "deviceId": device["uuid"],
+                    "deviceIP": device["deviceIP"],
+                } for device in typed_devices]
+            }
+            response = self.request("POST", "template/config/device/mode/cli", headers=headers, data=encode_json(payload))
+            responses.append(decode_json(response.content))
+            self.invalidate_cache(["templates", "devices", "attached"] + [f"device:{device['uuid']}" for device in typed_devices])
+        return responses
+
     # vManage invalidate router certificate
     def invalidate_certificate(self, chasis_number, serial_number):
+        return self.invalidate_certificates([(chasis_number, serial_number)])
+
+    # vManage invalidate certificates of many routers in one request
+    # devices is a list of (chasis_number, serial_number)
+    def invalidate_certificates(self, devices):
         headers = {
             "Content-Type": "application/json"
         }
@@ -446,36 +2317,69 @@ class vManage():
             "chasisNumber": chasis_number,
             "serialNumber": serial_number,
             "validity": "invalid"
-        }]
-        response = self.session.post(f"{self.base_url}/dataservice/certificate/save/vedge/list", headers=headers, data=json.dumps(payload), verify=False)
-        response = json.loads(response.text)
+        } for chasis_number, serial_number in devices]
+        response = self.request("POST", "certificate/save/vedge/list", headers=headers, data=encode_json(payload))
+        response = decode_json(response.content)
+        self.invalidate_cache(["devices"])
         return response
 
     # vManage sync controllers
     def sync_controllers(self):
-        response = self.session.post(f"{self.base_url}/dataservice/certificate/vedge/list", verify=False)
-        response = json.loads(response.text)
+        response = self.request("POST", "certificate/vedge/list")
+        response = decode_json(response.content)
         return response
 
     # vManage completely remove router
     def decommission_device(self, device_uuid):
-        response = self.session.put(f"{self.base_url}/dataservice/system/device/decommission/{device_uuid}", verify=False)
-        response = json.loads(response.text)
+        response = self.request("PUT", f"system/device/decommission/{device_uuid}")
+        response = decode_json(response.content)
+        self.invalidate_cache([f"device:{device_uuid}", "devices", "templates", "attached"])
         return response
 
     # vManage completely remove router
     def completely_remove_device(self, device_uuid):
-        response = self.session.delete(f"{self.base_url}/dataservice/system/device/{device_uuid}", verify=False)
-        response = json.loads(response.text)
+        response = self.request("DELETE", f"system/device/{device_uuid}")
+        response = decode_json(response.content)
+        self.invalidate_cache([f"device:{device_uuid}", "devices", "templates", "attached"])
         return response
 
+    # vManage get action status summary
+    def get_action_summary(self, action_id):
+        response = self.request("GET", f"device/action/status/{action_id}")
+        response = decode_json(response.content)
+        if response["summary"]["status"] == "done":
+            governor.finish_push(action_id)
+        return response["summary"]
+
     # vManage track action status
     def track_action_status(self, action_id):
-        response = self.session.get(f"{self.base_url}/dataservice/device/action/status/{action_id}", verify=False)
-        response = json.loads(response.text)
-        return response["summary"]["status"]
+        return self.get_action_summary(action_id)["status"]
 
 # initialize app
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SD-WAN device lifecycle management")
+    parser.add_argument("--refresh", action="store_true", help="bypass cached vManage reads and download them again")
+    parser.add_argument("--diff", action="store_true", help="only reattach routers whose template input values changed")
+    parser.add_argument("--dry-run", action="store_true", help="show the per-router changes without reattaching routers")
+    parser.add_argument("--snapshot", help="JSON snapshot of deployed template inputs to compare against instead of vManage")
+    parser.add_argument("--changes", help="JSON file with the template changes for configure_changes")
+    parser.add_argument("--resume", action="store_true", help="resume an interrupted run, skipping the steps recorded in the run journal")
+    parser.add_argument("--metrics", help="export run metrics to a .json file or an OpenMetrics text file")
+    parser.add_argument("--batch", metavar="JOB_FILE", help="run the workflows of a YAML or JSON job file without prompts, then exit")
+    parser.add_argument("--convert", nargs=2, metavar=("SOURCE", "DESTINATION"), help="convert a mapping file between .xlsx and a CSV/Parquet directory, then exit")
+    args = parser.parse_args()
+    cache_refresh = args.refresh
+    metrics_export = args.metrics or metrics_export
+    diff_mode = args.diff
+    dry_run = args.dry_run
+    resume_run = args.resume
+    input_snapshot_file = args.snapshot or input_snapshot_file
+    template_changes_file = args.changes or template_changes_file
+    if args.convert:
+        convert_mapping(*args.convert)
+        parser.exit()
+    if args.batch:
+        results = batch_starter(args.batch)
+        parser.exit(0 if all(result["status"] == "success" for result in results) else 1)
     print("Initializing app...")
     menu()
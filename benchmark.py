@@ -0,0 +1,200 @@
+""" Copyright (c) 2021 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+           https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import os, sys, json, time, argparse, resource, statistics, subprocess, tempfile, contextlib, multiprocessing, urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from vmanage_simulator import Fleet, start_simulator
+
+# benchmark scenarios, one per workflow in automate.py
+scenarios = ["commission", "decommission", "rma", "reclassification", "configure_changes"]
+
+# call a simulator control endpoint
+def simulator_control(base_url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    with urllib.request.urlopen(urllib.request.Request(f"{base_url}{path}", data=data, method="POST" if data is not None else "GET")) as response:
+        return json.loads(response.read())
+
+# write the mapping sheet a scenario needs, sized to the fleet and limited to rows entries
+def build_mapping(scenario, fleet, rows, file):
+    import automate
+    if scenario == "commission":
+        chassis_numbers = [chassis_number for chassis_number, host_name in fleet["unattached"][:rows]]
+        templates = fleet["templates"]
+        mapping = [{
+            "TemplateName": template_name,
+            "DeviceChassisNumber": ",".join(chassis_numbers[i::len(templates)])
+        } for i, template_name in enumerate(templates) if chassis_numbers[i::len(templates)]]
+        sheet_name = "Commission"
+    elif scenario == "rma":
+        pairs = list(zip(fleet["attached"], fleet["unattached"]))[:rows]
+        mapping = [{
+            "OldDevice": old_device[0],
+            "NewDevice": new_device[0],
+            "RMAviaTAC": "Y" if i % 2 == 0 else "N"
+        } for i, (old_device, new_device) in enumerate(pairs)]
+        sheet_name = "RMA"
+    elif scenario == "reclassification":
+        templates = fleet["templates"]
+        mapping = [{
+            "DeviceChassisNumber": chassis_number,
+            "TemplateName": templates[(templates.index(template_name) + 1) % len(templates)]
+        } for chassis_number, host_name, template_name in fleet["attached"][:rows]]
+        sheet_name = "Reclassification"
+    else:
+        return
+    automate.write_excel(file, sheet_name, mapping)
+
+# run one workflow against the simulator in this process and measure it
+def run_scenario(scenario, base_url, rows, mapping_format, workdir, verbose=False):
+    import automate
+    host, port = base_url.split("://", 1)[1].rsplit(":", 1)
+    automate.vmanage_scheme = "http"
+    automate.vmanage_host = host
+    automate.vmanage_port = port
+    automate.vmanage_username = "admin"
+    automate.vmanage_password = "admin"
+    automate.vmanage_cache_file = ""
+    automate.vmanage_journal_file = os.path.join(workdir, f"{scenario}-journal.jsonl")
+    automate.vmanage_action_poll_interval = 0.1
+
+    fleet = simulator_control(base_url, "/_reset", {})
+    file = os.path.join(workdir, f"{scenario}.xlsx" if mapping_format == "xlsx" else f"{scenario}-mapping")
+    build_mapping(scenario, fleet, rows, file)
+    automate.workbook_sessions.clear()
+
+    # scripted answers to the interactive prompts of each workflow
+    if scenario == "commission":
+        runs = [(1, ["1", file]), (1, ["2", file])]
+    elif scenario == "decommission":
+        runs = [(2, [",".join(host_name for chassis_number, host_name, template_name in fleet["attached"][:rows])])]
+    elif scenario == "rma":
+        runs = [(3, [file])]
+    elif scenario == "reclassification":
+        runs = [(4, ["1", file]), (4, ["2", file])]
+    else:
+        runs = [(5, [fleet["templates"][0]])]
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull):
+        for workflow_id, answers in runs:
+            answers = iter(answers)
+            automate.input = lambda prompt="": next(answers)
+            automate.workflow_starter(workflow_id)
+    wall_time = time.perf_counter() - started
+
+    stats = simulator_control(base_url, "/_stats")
+    return {
+        "scenario": scenario,
+        "wall_time": round(wall_time, 3),
+        "requests": stats["requests"],
+        "bytes_sent": stats["bytes_received"],
+        "bytes_received": stats["bytes_sent"],
+        "throttled": stats["throttled"],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+# run every scenario in a fresh process so the peak RSS is measured per scenario
+def run_benchmark(selected, fleet_size, latency, job_duration, rows, mapping_format, verbose=False, max_concurrent=0):
+    server = start_simulator(fleet_size=fleet_size, latency=latency, job_duration=job_duration, max_concurrent=max_concurrent)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for scenario in selected:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    result = executor.submit(run_scenario, scenario, base_url, rows, mapping_format, workdir, verbose).result()
+                result["fleet"] = fleet_size
+                results.append(result)
+                print(f"{scenario:<18} {fleet_size:>7} {result['wall_time']:>9.2f}s {result['requests']:>9} {result['bytes_sent'] / 1e6:>9.2f}MB {result['bytes_received'] / 1e6:>9.2f}MB {result['peak_rss_mb']:>8.1f}MB", flush=True)
+    finally:
+        server.shutdown()
+    return results
+
+# median seconds of repeated calls
+def median_time(function, repeat):
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+# time importing automate in a fresh interpreter, as it loads now and with the spreadsheet library loaded eagerly,
+# and time decoding a device list response of fleet_size devices with each JSON decoding path
+def run_micro_benchmark(fleet_size, repeat=5):
+    import requests, automate
+    directory = os.path.dirname(os.path.abspath(__file__))
+    startup = {
+        "import automate": "import automate",
+        "import automate with openpyxl": "import openpyxl, automate"
+    }
+    print(f"{'startup':<40} {'median':>10}")
+    for label, statement in startup.items():
+        seconds = median_time(lambda: subprocess.run([sys.executable, "-c", statement], cwd=directory, check=True), repeat)
+        print(f"{label:<40} {seconds * 1000:>8.1f}ms")
+    loaded = subprocess.run([sys.executable, "-c", "import sys, automate; print('openpyxl' in sys.modules)"], cwd=directory, capture_output=True, text=True).stdout.strip()
+    print(f"{'openpyxl loaded by import automate':<40} {loaded:>10}")
+
+    body = Fleet(fleet_size, 20, 1.0).device_list_json()
+    # the former path: requests detects the charset of the body to build response.text, then json.loads parses the text
+    def decode_text():
+        response = requests.models.Response()
+        response._content = body
+        response.encoding = None
+        return json.loads(response.text)
+    stdlib_codec = automate.JsonCodec("json")
+    decoders = {"json.loads(response.text)": decode_text, "stdlib codec from bytes": lambda: stdlib_codec.loads(body)}
+    try:
+        orjson_codec = automate.JsonCodec("orjson")
+        decoders["orjson codec from bytes"] = lambda: orjson_codec.loads(body)
+    except ImportError:
+        print("orjson is not installed, only the standard library codec is timed")
+    # the path get_device_list takes: the response chunks are decoded incrementally by the codec into compact records,
+    # and the cached compact list of a later run
+    chunks = [body[start:start + 65536] for start in range(0, len(body), 65536)]
+    decoders[f"stream_device_list ({automate.codec.name} codec)"] = lambda: [automate.DeviceRecord.from_dict(device) for device in automate.iter_json_array(iter(chunks))]
+    records = [automate.DeviceRecord.from_dict(device) for device in automate.iter_json_array(iter(chunks))]
+    compact = automate.encode_json([record.values() for record in records])
+    decoders[f"cached compact list ({automate.codec.name} codec)"] = lambda: [automate.DeviceRecord(*values) for values in automate.codec.loads(compact)]
+    print()
+    print(f"{f'decode {len(body) / 1e6:.1f}MB device list':<40} {'median':>10}")
+    for label, decoder in decoders.items():
+        seconds = median_time(decoder, repeat)
+        print(f"{label:<40} {seconds * 1000:>8.1f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the device lifecycle workflows against the local vManage simulator")
+    parser.add_argument("--scenario", choices=scenarios, action="append", help="scenario to run, all by default")
+    parser.add_argument("--fleet", type=int, action="append", help="fleet size, e.g. 1000, 10000 or 50000 (repeatable)")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated seconds per vManage request")
+    parser.add_argument("--job-duration", type=float, default=0.5, help="simulated seconds per vManage action")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="simulated vManage requests in flight before it answers 429, 0 for no limit")
+    parser.add_argument("--rows", type=int, default=200, help="mapping rows per scenario")
+    parser.add_argument("--mapping-format", choices=["xlsx", "csv"], default="xlsx")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the workflows")
+    parser.add_argument("--micro", action="store_true", help="only time importing automate and decoding a device list response")
+    args = parser.parse_args()
+
+    if args.micro:
+        for fleet_size in args.fleet or [10000]:
+            run_micro_benchmark(fleet_size)
+        parser.exit()
+
+    print(f"{'scenario':<18} {'fleet':>7} {'wall':>10} {'requests':>9} {'sent':>11} {'received':>11} {'peak rss':>10}")
+    results = []
+    for fleet_size in args.fleet or [1000]:
+        results += run_benchmark(args.scenario or scenarios, fleet_size, args.latency, args.job_duration, args.rows, args.mapping_format, args.verbose, args.max_concurrent)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,98 @@
+""" Copyright (c) 2021 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+           https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import json, unittest
+import automate
+
+# a device list response with a header before the data, escapes, multibyte UTF-8 and numbers
+document = json.dumps({
+    "header": {"title": "Devices", "columns": [{"title": "host-name"}, {"title": "uuid"}], "generatedOn": 1792337797185},
+    "data": [
+        {"host-name": "store-1", "uuid": 'a"b\\c', "site-id": 100, "latitude": -33.8688, "tags": ["x", {"y": [1, 2]}]},
+        {"host-name": "café-日本-🛰", "uuid": "c}d]", "site-id": 1234567890123, "reachable": True, "template": None},
+        {"host-name": "store-3", "uuid": "e,f", "site-id": 3, "latitude": 1.5e-10},
+        {"host-name": "store-4", "uuid": "g", "site-id": 4}
+    ],
+    "footer": {"count": 4}
+}, ensure_ascii=False, indent=1).encode()
+
+# split bytes into chunks of size bytes
+def split(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+# define a test case for the streamed JSON array reader, run with each available codec
+class IterJsonArrayTest(unittest.TestCase):
+    codecs = ["json", "orjson"]
+
+    def setUp(self):
+        self.codec = automate.codec
+
+    def tearDown(self):
+        automate.codec = self.codec
+
+    # run a test body once per codec that is installed
+    def each_codec(self):
+        for name in self.codecs:
+            try:
+                automate.codec = automate.JsonCodec(name)
+            except ImportError:
+                continue
+            with self.subTest(codec=name):
+                yield name
+
+    def test_every_chunk_size(self):
+        expected = json.loads(document)["data"]
+        for name in self.each_codec():
+            for size in range(1, 80):
+                self.assertEqual(list(automate.iter_json_array(split(document, size))), expected, size)
+            self.assertEqual(list(automate.iter_json_array([document])), expected)
+
+    def test_decode_one_value_at_a_time(self):
+        values = [json.loads(document), {"uuid": 'x}"y\\'}, ["a]", [], {}], "é", 12, -0.5, True, None]
+        body = b" ".join(json.dumps(value, ensure_ascii=False).encode() for value in values)
+        for name in self.each_codec():
+            for size in range(1, 80):
+                reader = automate.JsonStreamReader(split(body, size))
+                self.assertEqual([reader.decode() for value in values], values, size)
+
+    def test_numbers_split_across_chunks(self):
+        data = b'{"data": [1234567890, -1.5e+10, 0.25, 7]}'
+        for name in self.each_codec():
+            for boundary in range(1, len(data)):
+                self.assertEqual(list(automate.iter_json_array([data[:boundary], data[boundary:]])), [1234567890, -1.5e+10, 0.25, 7], boundary)
+
+    def test_multibyte_utf8_split_across_chunks(self):
+        data = json.dumps({"data": [{"host-name": "é日本🛰"}, "ü"]}, ensure_ascii=False).encode()
+        for name in self.each_codec():
+            for boundary in range(1, len(data)):
+                self.assertEqual(list(automate.iter_json_array([data[:boundary], data[boundary:]])), [{"host-name": "é日本🛰"}, "ü"], boundary)
+
+    def test_nested_values_one_at_a_time(self):
+        data = [{"device": {"interfaces": [{"name": f"ge0/{index}"}]}, "index": index} for index in range(50)]
+        body = json.dumps({"data": data}).encode()
+        for name in self.each_codec():
+            self.assertEqual(list(automate.iter_json_array(split(body, 64))), data)
+
+    def test_other_key_and_empty_array(self):
+        for name in self.each_codec():
+            self.assertEqual(list(automate.iter_json_array([b'{"data": []}'])), [])
+            self.assertEqual(list(automate.iter_json_array([b'{"header": {}}'])), [])
+            self.assertEqual(list(automate.iter_json_array([b'{"data": [1]}'], key="header")), [])
+
+    def test_truncated_stream(self):
+        for name in self.each_codec():
+            with self.assertRaises(ValueError):
+                list(automate.iter_json_array(split(document[:len(document) // 2], 16)))
+
+if __name__ == '__main__':
+    unittest.main()
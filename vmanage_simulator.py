@@ -0,0 +1,368 @@
+""" Copyright (c) 2021 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+           https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import re, json, time, argparse, threading, itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# share of the fleet attached to a template, the rest is onboarded but not yet attached
+attached_share = 0.9
+
+# define a class for the simulated fabric: devices, device templates, feature templates and actions
+class Fleet():
+    def __init__(self, fleet_size, template_count=20, job_duration=1.0):
+        self.job_duration = job_duration
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.templates = {}
+        self.feature_templates = {}
+        self.devices = {}
+        self.inputs = {}
+        self.actions = {}
+        self.device_list_body = None
+        for i in range(template_count):
+            self.add_template({
+                "templateName": f"Store-Template-{i}",
+                "templateDescription": f"Store template {i}",
+                "deviceType": "vedge-C8000V",
+                "configType": "template",
+                "factoryDefault": False,
+                "policyId": "",
+                "featureTemplateUidRange": [],
+                "generalTemplates": [
+                    {"templateId": "ft-system", "templateType": "cedge_system"},
+                    {"templateId": "ft-vpn", "templateType": "cisco_vpn", "subTemplates": [
+                        {"templateId": "ft-vpn-if", "templateType": "cisco_vpn_interface"}
+                    ]}
+                ]
+            }, template_id=f"template-{i}")
+        template_ids = list(self.templates)
+        attached = int(fleet_size * attached_share)
+        for i in range(fleet_size):
+            template_id = template_ids[i % len(template_ids)] if i < attached else None
+            self.add_device(i, template_id)
+
+    def add_template(self, config, template_id=None):
+        template_id = template_id or f"device-template-{next(self.ids)}"
+        self.templates[template_id] = dict(config, templateId=template_id)
+        return template_id
+
+    def add_device(self, i, template_id):
+        device_uuid = f"C8K-{i:08d}-0000-4000-8000-{i:012d}"
+        device = {
+            "deviceType": "vedge",
+            "serialNumber": f"{i:08X}",
+            "uuid": device_uuid,
+            "managementSystemIP": "0.0.0.0",
+            "chasisNumber": f"C8K-CHASSIS-{i:08d}",
+            "configOperationMode": "vmanage" if template_id else "cli",
+            "deviceModel": "vedge-C8000V",
+            "deviceState": "READY",
+            "validity": "valid",
+            "platformFamily": "c8000v",
+            "vedgeCertificateState": "certinstalled",
+            "rootCertHash": "1f2e3d4c5b6a7980" * 4,
+            "deviceEnterpriseCertificate": "",
+            "uploadSource": "File Upload",
+            "subjectSerialNumber": f"SN{i:08d}",
+            "cpuCount": 8,
+            "host-name": f"store-{i:06d}",
+            "deviceIP": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}",
+            "system-ip": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}",
+            "site-id": str(1000 + i),
+            "version": "17.6.3a",
+            "reachability": "reachable",
+            "personality": "vedge",
+            "lifeCycleRequired": True,
+            "expirationDate": "NA",
+            "hardwareCertSerialNumber": "NA",
+            "latitude": "37.666684",
+            "longitude": "-122.777023",
+            "template": "",
+            "draftMode": "Disabled"
+        }
+        if template_id:
+            device["templateId"] = template_id
+            device["template"] = self.templates[template_id]["templateName"]
+            device["templateStatus"] = "Success"
+        self.devices[device_uuid] = device
+
+    # template input variables of a device: the values it is attached with, or generated defaults
+    def template_input(self, template_id, device_uuid):
+        if (template_id, device_uuid) in self.inputs:
+            return dict(self.inputs[(template_id, device_uuid)], **{"csv-status": "complete"})
+        device = self.devices.get(device_uuid, {})
+        values = {
+            "csv-status": "in_complete",
+            "csv-deviceId": device_uuid,
+            "csv-deviceIP": device.get("deviceIP", ""),
+            "csv-host-name": device.get("host-name", ""),
+            "//system/host-name": device.get("host-name", ""),
+            "//system/system-ip": device.get("system-ip", ""),
+            "//system/site-id": device.get("site-id", "")
+        }
+        for interface in range(4):
+            values[f"/1/vpn_if_name_{interface}/interface/if-name"] = f"GigabitEthernet{interface}"
+            values[f"/1/vpn_if_name_{interface}/interface/description"] = f"Uplink {interface}"
+            values[f"/1/vpn_if_name_{interface}/interface/ip/address"] = f"192.168.{interface}.1/24"
+        return values
+
+    def device_list_json(self):
+        if self.device_list_body is None:
+            self.device_list_body = json.dumps({
+                "header": {"generatedOn": int(time.time() * 1000), "title": "Devices", "columns": [{"title": field, "property": field} for field in next(iter(self.devices.values()), {})]},
+                "data": list(self.devices.values())
+            }).encode()
+        return self.device_list_body
+
+    def changed(self):
+        self.device_list_body = None
+
+    def start_action(self, kind, count):
+        action_id = f"{kind}-{next(self.ids)}"
+        self.actions[action_id] = {"start": time.time(), "count": count}
+        return action_id
+
+    def action_summary(self, action_id):
+        action = self.actions.get(action_id)
+        if action is None:
+            return {"status": "done", "count": {"Failure": 1}}
+        if time.time() - action["start"] < self.job_duration:
+            return {"status": "in_progress", "count": {"In progress": action["count"]}}
+        return {"status": "done", "count": {"Success": action["count"]}}
+
+    # attach devices to templates and remember their input values
+    def attach(self, device_template_list):
+        count = 0
+        for device_template in device_template_list:
+            template_id = device_template["templateId"]
+            for values in device_template["device"]:
+                device = self.devices.get(values.get("csv-deviceId"))
+                if device is not None:
+                    device["templateId"] = template_id
+                    device["template"] = self.templates.get(template_id, {}).get("templateName", "")
+                    device["configOperationMode"] = "vmanage"
+                    self.inputs[(template_id, device["uuid"])] = {key: value for key, value in values.items() if key != "csv-status"}
+                count += 1
+        self.changed()
+        return self.start_action("push_feature_template_configuration", count)
+
+# define a class for the simulator HTTP request handler, answering the dataservice endpoints used by automate.py
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # silence per-request logging
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        path = self.path.split("?", 1)[0]
+        if path.startswith("/_"):
+            return self.control(method, path, body)
+        with server.stats_lock:
+            server.stats["requests"] += 1
+            server.stats["bytes_received"] += length + len(self.requestline) + len(str(self.headers))
+            throttled = bool(server.max_concurrent) and server.in_flight >= server.max_concurrent
+            if throttled:
+                server.stats["throttled"] += 1
+            else:
+                server.in_flight += 1
+        if throttled:
+            return self.reply(429, json.dumps({"error": {"message": "Too many requests"}}).encode())
+        try:
+            time.sleep(server.latency)
+            return self.answer(method, path, body)
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def answer(self, method, path, body):
+        server = self.server
+        if path == "/j_security_check":
+            session_id = f"session-{next(server.fleet.ids)}"
+            server.sessions[session_id] = time.time()
+            return self.reply(200, b"", "text/html", {"Set-Cookie": f"JSESSIONID={session_id}; Path=/"})
+        if not self.authenticated():
+            return self.reply(200, b"<html><body><form method='POST' action='j_security_check'></form></body></html>", "text/html")
+        if path == "/dataservice/client/token":
+            return self.reply(200, b"simulated-xsrf-token", "text/plain")
+        with server.fleet.lock:
+            response = self.route(method, path, json.loads(body) if body else None)
+        if response is None:
+            return self.reply(404, json.dumps({"error": {"message": f"{method} {path} not simulated"}}).encode())
+        return self.reply(200, response if isinstance(response, bytes) else json.dumps(response).encode())
+
+    def authenticated(self):
+        cookies = dict(cookie.strip().split("=", 1) for cookie in self.headers.get("Cookie", "").split(";") if "=" in cookie)
+        started = self.server.sessions.get(cookies.get("JSESSIONID"))
+        return started is not None and (not self.server.session_ttl or time.time() - started < self.server.session_ttl)
+
+    # answer a dataservice endpoint, None when it is not simulated
+    def route(self, method, path, payload):
+        fleet = self.server.fleet
+        path = path[len("/dataservice/"):] if path.startswith("/dataservice/") else path
+        if method == "GET" and path == "template/device":
+            return {"data": [{key: value for key, value in template.items() if key != "generalTemplates"} for template in fleet.templates.values()]}
+        if method == "GET" and path == "template/feature":
+            return {"data": list(fleet.feature_templates.values())}
+        if method == "POST" and path == "template/feature":
+            template_id = f"feature-{next(fleet.ids)}"
+            fleet.feature_templates[template_id] = dict(payload, templateId=template_id)
+            return {"templateId": template_id}
+        match = re.fullmatch(r"template/feature/object/(.+)", path)
+        if method == "GET" and match:
+            return fleet.feature_templates.get(match.group(1))
+        if method == "POST" and path == "template/device/feature":
+            return {"templateId": fleet.add_template(payload)}
+        match = re.fullmatch(r"template/device/object/(.+)", path)
+        if method == "GET" and match:
+            return fleet.templates.get(match.group(1))
+        if method == "POST" and path == "template/device/config/input":
+            return {"header": {"columns": []}, "data": [fleet.template_input(payload["templateId"], device_uuid) for device_uuid in payload["deviceIds"]]}
+        match = re.fullmatch(r"template/device/config/attached/(.+)", path)
+        if method == "GET" and match:
+            return {"data": [{"uuid": device["uuid"], "host-name": device["host-name"], "deviceIP": device["deviceIP"]} for device in fleet.devices.values() if device.get("templateId") == match.group(1)]}
+        if method == "POST" and path == "template/device/config/attachfeature":
+            return {"id": fleet.attach(payload["deviceTemplateList"])}
+        if method == "POST" and path == "template/config/device/mode/cli":
+            for values in payload["devices"]:
+                device = fleet.devices.get(values["deviceId"])
+                if device is not None:
+                    device.pop("templateId", None)
+                    device["template"] = ""
+                    device["configOperationMode"] = "cli"
+            fleet.changed()
+            return {"id": fleet.start_action("device_config_mode_cli", len(payload["devices"]))}
+        if method == "POST" and path == "certificate/save/vedge/list":
+            invalid = {(entry["chasisNumber"], entry["serialNumber"]) for entry in payload}
+            for device in fleet.devices.values():
+                if (device["chasisNumber"], device["serialNumber"]) in invalid:
+                    device["validity"] = "invalid"
+            fleet.changed()
+            return {"id": fleet.start_action("certificate_save", len(payload))}
+        if method == "POST" and path == "certificate/vedge/list":
+            return {"id": fleet.start_action("push_certificate_to_controllers", 1)}
+        match = re.fullmatch(r"system/device/decommission/(.+)", path)
+        if method == "PUT" and match:
+            device = fleet.devices.get(match.group(1))
+            if device is not None:
+                device["validity"] = "invalid"
+                device.pop("templateId", None)
+            fleet.changed()
+            return {"id": fleet.start_action("decommission", 1)}
+        match = re.fullmatch(r"system/device/(.+)", path)
+        if method == "DELETE" and match:
+            fleet.devices.pop(match.group(1), None)
+            fleet.changed()
+            return {"id": match.group(1)}
+        if method == "GET" and match:
+            return fleet.device_list_json()
+        match = re.fullmatch(r"device/action/status/(.+)", path)
+        if method == "GET" and match:
+            return {"summary": fleet.action_summary(match.group(1)), "data": []}
+        return None
+
+    # simulator control endpoints, not counted in the statistics
+    # POST /_reset rebuilds the fleet, GET /_stats returns counters, GET /_fleet describes the fleet
+    def control(self, method, path, body):
+        server = self.server
+        if path == "/_reset" and method == "POST":
+            options = json.loads(body) if body else {}
+            server.reset(**options)
+            return self.reply(200, json.dumps(server.fleet_summary()).encode())
+        if path == "/_fleet":
+            return self.reply(200, json.dumps(server.fleet_summary()).encode())
+        if path == "/_stats":
+            with server.stats_lock:
+                return self.reply(200, json.dumps(server.stats).encode())
+        return self.reply(404, b"{}")
+
+    def reply(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if not self.path.startswith("/_"):
+            with self.server.stats_lock:
+                self.server.stats["bytes_sent"] += len(body)
+
+# define a class for the simulator server holding the fleet, sessions and statistics
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fleet_size=1000, latency=0.0, job_duration=1.0, template_count=20, session_ttl=0, max_concurrent=0):
+        super().__init__(address, SimulatorHandler)
+        self.latency = latency
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.stats_lock = threading.Lock()
+        self.reset(fleet_size, latency, job_duration, template_count)
+
+    def reset(self, fleet_size=None, latency=None, job_duration=None, template_count=None):
+        fleet = getattr(self, "fleet", None)
+        self.fleet_size = fleet_size or self.fleet_size
+        self.template_count = template_count or self.template_count
+        self.latency = self.latency if latency is None else latency
+        job_duration = (fleet.job_duration if fleet else 1.0) if job_duration is None else job_duration
+        self.fleet = Fleet(self.fleet_size, self.template_count, job_duration)
+        with self.stats_lock:
+            self.stats = {"requests": 0, "bytes_received": 0, "bytes_sent": 0, "throttled": 0}
+
+    # chassis numbers and names the benchmark needs to build mapping files
+    def fleet_summary(self):
+        devices = list(self.fleet.devices.values())
+        return {
+            "templates": [template["templateName"] for template in self.fleet.templates.values()],
+            "attached": [[device["chasisNumber"], device["host-name"], device["template"]] for device in devices if "templateId" in device],
+            "unattached": [[device["chasisNumber"], device["host-name"]] for device in devices if "templateId" not in device]
+        }
+
+# start a simulator on a background thread, port 0 picks a free port
+def start_simulator(host="127.0.0.1", port=0, **options):
+    server = SimulatorServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local vManage simulator for the device lifecycle workflows")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--fleet", type=int, default=1000, help="number of simulated edge routers")
+    parser.add_argument("--templates", type=int, default=20, help="number of device templates")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--job-duration", type=float, default=1.0, help="seconds until an action reports done")
+    parser.add_argument("--session-ttl", type=float, default=0, help="seconds until a login session expires, 0 for never")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="requests in flight before answering 429, 0 for no limit")
+    args = parser.parse_args()
+    server = SimulatorServer((args.host, args.port), fleet_size=args.fleet, latency=args.latency, job_duration=args.job_duration, template_count=args.templates, session_ttl=args.session_ttl, max_concurrent=args.max_concurrent)
+    print(f"Simulating vManage with {args.fleet} devices on http://{args.host}:{args.port} (set VMANAGE_SCHEME=http)")
+    server.serve_forever()